@@ -0,0 +1,85 @@
+import http.client
+import os
+import socket
+import threading
+
+import pytest
+
+os.environ.setdefault("WARM_CACHE_PATH", "")
+
+import trading_bot_lib as lib  # noqa: E402
+
+
+class DropSecondRequestServer:
+    """
+    Server keep-alive một kết nối: trả lời request đầu tiên, đọc hết request
+    thứ hai rồi đóng socket không trả lời (server đã nhận lệnh nhưng mất phản hồi).
+    Kết nối mới sau đó được trả lời bình thường.
+    """
+
+    RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: keep-alive\r\n\r\n{}"
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.requests = []
+        self._connections = 0
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _read_request(self, conn):
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = conn.recv(4096)
+            if not chunk:
+                return None
+            data += chunk
+        head, body = data.split(b"\r\n\r\n", 1)
+        length = 0
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value)
+        while len(body) < length:
+            body += conn.recv(4096)
+        return head.split(b" ", 1)[0].decode()
+
+    def _serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            self._connections += 1
+            first_connection = self._connections == 1
+            served = 0
+            while True:
+                method = self._read_request(conn)
+                if method is None:
+                    break
+                self.requests.append(method)
+                served += 1
+                if first_connection and served == 2:
+                    conn.close()
+                    break
+                conn.sendall(self.RESPONSE)
+
+
+def test_post_is_not_replayed_after_it_was_sent_on_reused_socket():
+    server = DropSecondRequestServer()
+    pool = lib.HttpConnectionPool(timeout=5)
+    url = f"http://127.0.0.1:{server.port}/fapi/v1/order"
+
+    assert pool.request("POST", url, body=b"symbol=BTCUSDT")[0] == 200
+    with pytest.raises((http.client.HTTPException, OSError)):
+        pool.request("POST", url, body=b"symbol=BTCUSDT")
+
+    assert server.requests == ["POST", "POST"]
+
+
+def test_get_is_retried_on_fresh_socket_after_reused_socket_drops():
+    server = DropSecondRequestServer()
+    pool = lib.HttpConnectionPool(timeout=5)
+    url = f"http://127.0.0.1:{server.port}/fapi/v1/time"
+
+    assert pool.request("GET", url)[0] == 200
+    assert pool.request("GET", url)[0] == 200
+    assert server.requests == ["GET", "GET", "GET"]
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+os.environ.setdefault("WARM_CACHE_PATH", "")
+
+import trading_bot_lib as lib  # noqa: E402
+
+
+class BlockingPool:
+    """Thay _HTTP_POOL: request đầu tiên bị giữ lại tới khi release_first được set"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = 0
+        self.first_started = threading.Event()
+        self.release_first = threading.Event()
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None):
+        with self._lock:
+            index = self.calls
+            self.calls += 1
+        if index == 0:
+            self.first_started.set()
+            self.release_first.wait(5)
+        return 200, "OK", {}, json.dumps(self.responses[index]).encode()
+
+
+def _run_interleaving(monkeypatch, responses, read, invalidate):
+    """Lần đọc A đang chờ HTTP -> invalidate -> lần đọc B; trả về (kết quả B, pool)"""
+    pool = BlockingPool(responses)
+    monkeypatch.setattr(lib, "_HTTP_POOL", pool)
+    monkeypatch.setattr(lib, "get_synchronized_timestamp", lambda: 1)
+
+    first = threading.Thread(target=read)
+    first.start()
+    assert pool.first_started.wait(5)
+    invalidate()
+    result = {}
+    second = threading.Thread(target=lambda: result.setdefault("value", read()))
+    second.start()
+    second.join(0.5)
+    pool.release_first.set()
+    first.join(5)
+    second.join(5)
+    return result["value"], pool
+
+
+def _position(amount):
+    return [{"symbol": "BTCUSDT", "positionAmt": amount, "entryPrice": "100", "leverage": "5"}]
+
+
+def test_position_read_after_invalidate_does_not_join_pre_fill_request(monkeypatch):
+    book = lib.PositionBook()
+    snapshot, pool = _run_interleaving(
+        monkeypatch,
+        [_position("0"), _position("1")],
+        lambda: book.get_snapshot("K", "S"),
+        lambda: book.invalidate("K"),
+    )
+
+    assert pool.calls == 2
+    assert snapshot.positions["BTCUSDT"]["positionAmt"] == "1"
+    assert book.get("BTCUSDT", "K", "S")["positionAmt"] == "1"
+    assert book.discarded_count == 1
+
+
+def _account(balance):
+    return {
+        "assets": [{"asset": "USDT", "walletBalance": balance, "availableBalance": balance}],
+        "positions": [],
+    }
+
+
+def test_account_read_after_invalidate_does_not_join_pre_fill_request(monkeypatch):
+    state = lib.AccountState()
+    snapshot, pool = _run_interleaving(
+        monkeypatch,
+        [_account("100"), _account("80")],
+        lambda: state.get("K", "S"),
+        lambda: state.invalidate("K"),
+    )
+
+    assert pool.calls == 2
+    assert snapshot.assets["USDT"] == (80.0, 80.0)
+    assert state.get("K", "S").assets["USDT"] == (80.0, 80.0)
+    assert state.discarded_count == 1
@@ -3,8 +3,10 @@ import hmac
 import hashlib
 import time
 import threading
-import urllib.request
 import urllib.parse
+import http.client
+import gzip
+import zlib
 import numpy as np
 import websocket
 import logging
@@ -16,34 +18,170 @@ import random
 import queue
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from types import MappingProxyType
 import ssl
+import re
+import functools
+import sqlite3
+import weakref
+from contextlib import contextmanager
+
+try:
+    import orjson  # Tùy chọn: giải mã JSON nhanh hơn nhiều so với json chuẩn
+except ImportError:
+    orjson = None
+
+
+# Cấu hình pool kết nối HTTP keep-alive
+_HTTP_POOL_SIZE = 10  # Số kết nối tối đa cho mỗi host
+_HTTP_POOL_IDLE_TIMEOUT = 30  # Đóng kết nối rảnh quá thời gian này (giây)
+_HTTP_TIMEOUT = 20
+_IDEMPOTENT_METHODS = {"GET", "PUT", "DELETE"}  # Được gửi lại khi kết nối keep-alive cũ bị đóng
+
+# Giới hạn của Binance Futures (theo IP / tài khoản)
+_REQUEST_WEIGHT_LIMIT_1M = 2400
+_ORDER_LIMIT_10S = 300
+_ORDER_LIMIT_1M = 1200
+_RATE_LIMIT_SAFETY = 0.8  # Chỉ dùng 80% ngân sách để chừa chỗ cho sai lệch
+
+# Weight của từng endpoint (mặc định 1)
+_ENDPOINT_WEIGHTS = {
+    "/fapi/v2/account": 5,
+    "/fapi/v2/positionRisk": 5,
+}
+# Endpoint có weight khác nhau khi có/không có symbol: (có symbol, không symbol)
+_SYMBOL_OPTIONAL_WEIGHTS = {
+    "/fapi/v1/ticker/24hr": (1, 40),
+    "/fapi/v1/ticker/price": (1, 2),
+    "/fapi/v1/premiumIndex": (1, 10),
+}
+_ORDER_ENDPOINTS = {"/fapi/v1/order"}
+
+# Mức ưu tiên của request (số nhỏ = ưu tiên cao hơn)
+PRIORITY_ORDER = 0  # Đặt/hủy lệnh, đóng vị thế, đòn bẩy
+PRIORITY_ACCOUNT = 1  # Số dư, vị thế, thời gian server
+PRIORITY_SCAN = 2  # Quét thị trường, klines
+_ENDPOINT_PRIORITIES = {
+    "/fapi/v1/order": PRIORITY_ORDER,
+    "/fapi/v1/allOpenOrders": PRIORITY_ORDER,
+    "/fapi/v1/leverage": PRIORITY_ORDER,
+    "/fapi/v2/account": PRIORITY_ACCOUNT,
+    "/fapi/v2/positionRisk": PRIORITY_ACCOUNT,
+    "/fapi/v1/time": PRIORITY_ACCOUNT,
+    "/fapi/v1/listenKey": PRIORITY_ACCOUNT,
+}
+# Phần ngân sách weight mà mỗi mức ưu tiên được dùng (phần còn lại dành cho mức cao hơn)
+_PRIORITY_BUDGET_SHARE = {
+    PRIORITY_ORDER: 1.0,
+    PRIORITY_ACCOUNT: 0.9,
+    PRIORITY_SCAN: 0.75,
+}
+_MAX_CONCURRENT_REQUESTS = _HTTP_POOL_SIZE
+_SCAN_MAX_WAIT = 5  # Request quét chờ quá lâu sẽ bị bỏ (giây)
+
+# Ngắt mạch khi Binance báo quá tải (429/418/5xx)
+_BREAKER_FAILURE_THRESHOLD = 5  # Số lỗi 5xx trong cửa sổ để ngắt mạch
+_BREAKER_FAILURE_WINDOW = 10  # Cửa sổ đếm lỗi (giây)
+_BREAKER_BASE_DELAY = 1  # Backoff nhỏ nhất (giây)
+_BREAKER_MAX_DELAY = 120  # Backoff lớn nhất (giây)
+_BREAKER_BAN_DELAY = 60  # Thời gian mở mạch tối thiểu khi bị 418 (IP bị cấm)
+_BREAKER_MAX_WAIT = 30  # Request ưu tiên cao chờ mạch đóng tối đa (giây)
+
+# Đo lường REST
+_REST_METRICS_LOG_INTERVAL = 300  # Ghi log tóm tắt mỗi 5 phút
+_HISTOGRAM_PRECISION = 0.05  # Sai số tương đối của bucket histogram (5%)
+_API_COST_SUMMARY_TOP_N = 10  # Số bot tốn API nhất liệt kê riêng, còn lại gộp một dòng
+_TELEGRAM_MAX_MESSAGE = 4000  # Telegram giới hạn 4096 ký tự, chừa chỗ cho escape HTML
+
+# Đồng bộ đồng hồ với server Binance
+_CLOCK_SYNC_INTERVAL = 60  # Giây giữa các lần lấy mẫu /fapi/v1/time
+_CLOCK_MAX_SAMPLES = 10  # Số mẫu giữ lại để ước lượng độ trôi
+_CLOCK_MAX_DRIFT = 0.001  # Độ trôi tối đa chấp nhận (ms/ms)
+
+# Cache dùng chung (TTLCache)
+_CACHE_DEFAULT_MAX_SIZE = 1024  # Số key tối đa mỗi cache trước khi loại bỏ theo LRU
 
-
-_BINANCE_LAST_REQUEST_TIME = 0
-_BINANCE_RATE_LOCK = threading.Lock()
-_BINANCE_MIN_INTERVAL = 0.15  # Tăng khoảng cách request để tránh rate limit
-
-_USDT_CACHE = {"cặp": [], "cập_nhật_cuối": 0}
-_USDT_CACHE_TTL = 60  # Tăng thời gian cache
-
-_VOLUME_CACHE = {"dữ_liệu": [], "cập_nhật_cuối": 0}
 _VOLUME_CACHE_TTL = 30
+_VOLUME_CACHE_STALE = 30  # Được dùng dữ liệu cũ thêm tối đa bấy nhiêu giây khi đang làm mới
 
-_PRICE_CACHE = {"dữ_liệu": {}, "cập_nhật_cuối": 0}
-_PRICE_CACHE_TTL = 5
-
-_LEVERAGE_CACHE = {"dữ_liệu": {}, "cập_nhật_cuối": 0}
-_LEVERAGE_CACHE_TTL = 3600
+_PRICE_CACHE_TTL = 5  # Tuổi tối đa của giá từng symbol (giây)
+_PRICE_CACHE_MAX_SIZE = 2048
 
-_STEP_SIZE_CACHE = {"dữ_liệu": {}, "cập_nhật_cuối": 0}
-_STEP_SIZE_CACHE_TTL = 3600
-
-_EXCHANGE_INFO_CACHE = {"dữ_liệu": None, "cập_nhật_cuối": 0}
 _EXCHANGE_INFO_CACHE_TTL = 3600
+_EXCHANGE_INFO_CACHE_STALE = 600
+
+_ACCOUNT_STATE_MAX_AGE = 5  # Giây: số dư/ký quỹ cũ hơn mức này thì tải lại /fapi/v2/account
+_POSITION_BOOK_MAX_AGE = 5  # Giây: ảnh chụp positionRisk cũ hơn mức này thì tải lại
+
+# User data stream: sàn đẩy thay đổi vị thế/số dư/lệnh qua websocket thay cho polling
+# (đổi URL qua biến môi trường để chạy với server giả lập khi kiểm thử)
+_FUTURES_REST_BASE = os.getenv("BINANCE_FUTURES_REST_URL", "https://fapi.binance.com")
+_FUTURES_WS_BASE = os.getenv("BINANCE_FUTURES_WS_URL", "wss://fstream.binance.com")
+_USER_STREAM_KEEPALIVE = 30 * 60  # Giây giữa các lần gia hạn listenKey (hết hạn sau 60 phút)
+_USER_STREAM_RECONNECT_DELAY = 5
+_USER_STREAM_POSITION_MAX_AGE = 60  # Khi stream hoạt động, positionRisk chỉ để đối soát
+_USER_STREAM_ACCOUNT_MAX_AGE = 30  # Stream không có availableBalance/ký quỹ: vẫn đối soát định kỳ
+_USER_STREAM_MAX_ORDERS = 500  # Số lệnh gần nhất giữ trong bộ nhớ
+
+# WebSocket giá: gộp nhiều symbol vào ít kết nối /stream, thêm/bớt bằng SUBSCRIBE/UNSUBSCRIBE
+_WS_MAX_STREAMS_PER_CONNECTION = 200  # Giới hạn stream của sàn cho mỗi kết nối
+_WS_CONTROL_INTERVAL = 0.25  # Giây tối thiểu giữa 2 tin điều khiển (sàn cho tối đa 10 tin/giây)
+_WS_RECONNECT_DELAY = 5
+
+_WS_DISPATCH_WORKERS = 4  # Luồng gọi callback giá (mỗi bên đăng ký tối đa một luồng tại một thời điểm)
+_PRICE_BOARD_CAPACITY = 512  # Số symbol cấp phát sẵn cho bảng giá (tự nới gấp đôi khi đầy)
+_WS_PRICE_MAX_AGE = 5  # Giá websocket cũ hơn mức này (giây) thì hỏi REST
+
+# Loại stream giá mà bên đăng ký cần, xếp từ rẻ (ít tin nhắn) tới đắt
+STREAM_MARK_PRICE = "markPrice@1s"  # Mark price, 1 tin/giây
+STREAM_AGG_TRADE = "aggTrade"  # Giao dịch đã gộp theo lệnh taker
+STREAM_TRADE = "trade"  # Từng giao dịch
+STREAM_BOOK_TICKER = "bookTicker"  # Giá mua/bán tốt nhất, đẩy mỗi khi sổ lệnh đổi
+# Stream nào đáp ứng được nhu cầu của stream khác (trade chứa mọi thông tin của aggTrade)
+_STREAM_SATISFIES = {STREAM_TRADE: {STREAM_AGG_TRADE}}
+# Trường "e" trong frame -> loại stream
+_STREAM_EVENT_TYPES = {
+    "markPriceUpdate": STREAM_MARK_PRICE,
+    "aggTrade": STREAM_AGG_TRADE,
+    "trade": STREAM_TRADE,
+    "bookTicker": STREAM_BOOK_TICKER,
+}
+
+_LEVERAGE_BRACKET_TTL = 3600
+_LEVERAGE_BRACKET_STALE = 600
+_LEVERAGE_BRACKET_FAILURE_BACKOFF = 30  # Tải bracket lỗi: chờ rồi mới thử lại (giây, tăng gấp đôi)
+_LEVERAGE_BRACKET_FAILURE_MAX_BACKOFF = 600
+_LEVERAGE_FALLBACK = 100  # Dùng khi chưa có dữ liệu bracket (set_leverage sẽ tự báo lỗi)
+_LEVERAGE_PREWARM_TOP_N = 0  # Đặt sẵn đòn bẩy cho N coin ứng viên hàng đầu khi quét (0 = tắt)
+
+_ANALYSIS_CACHE_TTL = 30
+_ANALYSIS_CACHE_MAX_SIZE = 512
+
+# Làm mới dữ liệu thị trường ở luồng nền
+_MARKET_REFRESH_LEAD = 0.8  # Làm mới khi đã qua 80% TTL, trước khi cache hết hạn
+_MARKET_REFRESH_RETRY = 5  # Giây chờ trước khi thử lại sau lỗi
+_PRICE_DEMAND_WINDOW = 60  # Chỉ làm mới bảng giá nếu có bot đọc giá trong bấy nhiêu giây
+
+# Cache trên đĩa để khởi động lại nhanh (không phải tải lại toàn bộ metadata sau crash)
+_WARM_CACHE_PATH = os.getenv("WARM_CACHE_PATH", "market_cache.sqlite3")
+_WARM_CACHE_MAX_AGE = 1800  # Dữ liệu trên đĩa cũ hơn bấy nhiêu giây thì bỏ qua
+_WARM_CACHE_SAVE_INTERVAL = 300  # Giây tối thiểu giữa hai lần ghi cùng một key
 
 _SYMBOL_BLACKLIST = {"BTCUSDT", "ETHUSDT"}
-_HIGH_SPREAD_SYMBOLS = set()  # Các symbol có spread cao
+
+# Cache âm: tạm bỏ qua symbol vừa lỗi, thời gian chặn tăng gấp đôi sau mỗi lần lỗi
+_NEGATIVE_CACHE_BASE_TTL = 300
+_NEGATIVE_CACHE_MAX_TTL = 6 * 3600
+_NEGATIVE_CACHE_MAX_SIZE = 2048
+
+FAILURE_LEVERAGE = "leverage"  # set_leverage bị từ chối
+FAILURE_KLINES = "klines"  # Không đủ dữ liệu nến (coin mới niêm yết...)
+FAILURE_ORDER = "order"  # Lệnh bị sàn từ chối vì lý do riêng của symbol
+FAILURE_HIGH_SPREAD = "high_spread"  # Biên độ 24h vượt _MAX_SPREAD_PERCENT
+
+# Mã lỗi của TÀI KHOẢN (số dư, timestamp, key...) - không phải lỗi của symbol
+_ACCOUNT_LEVEL_ERROR_CODES = {-1021, -1022, -2014, -2015, -2019}
 
 # Biến để kiểm soát log spam
 _LAST_MARGIN_LOG_TIME = 0
@@ -308,14 +446,175 @@ def create_pyramiding_x_keyboard():
     }
 
 
-def _wait_for_rate_limit():
-    global _BINANCE_LAST_REQUEST_TIME
-    with _BINANCE_RATE_LOCK:
-        now = time.time()
-        delta = now - _BINANCE_LAST_REQUEST_TIME
-        if delta < _BINANCE_MIN_INTERVAL:
-            time.sleep(_BINANCE_MIN_INTERVAL - delta)
-        _BINANCE_LAST_REQUEST_TIME = time.time()
+def get_request_weight(path, params=None):
+    """Tính weight của một request theo bảng weight của Binance Futures"""
+    params = params or {}
+    if path == "/fapi/v1/klines":
+        limit = int(params.get("limit", 500))
+        if limit < 100:
+            return 1
+        if limit < 500:
+            return 2
+        if limit <= 1000:
+            return 5
+        return 10
+    if path in _SYMBOL_OPTIONAL_WEIGHTS:
+        with_symbol, without_symbol = _SYMBOL_OPTIONAL_WEIGHTS[path]
+        return with_symbol if params.get("symbol") else without_symbol
+    return _ENDPOINT_WEIGHTS.get(path, 1)
+
+
+def _split_request_url(url, params=None):
+    """Tách path và toàn bộ tham số (kể cả tham số đã nằm sẵn trong URL đã ký)"""
+    parts = urllib.parse.urlsplit(url)
+    query_params = dict(urllib.parse.parse_qsl(parts.query))
+    if params:
+        query_params.update(params)
+    return parts.path, query_params
+
+
+class BinanceRateLimiter:
+    """
+    Bộ điều phối request theo ngân sách thực của Binance:
+      - weight trong cửa sổ 1 phút
+      - số lệnh trong cửa sổ 10 giây và 1 phút
+      - 3 làn ưu tiên: lệnh > tài khoản/vị thế > quét thị trường
+    Làn cao luôn được phục vụ trước; làn quét chỉ dùng một phần ngân sách và bị bỏ
+    nếu chờ quá _SCAN_MAX_WAIT giây.
+    Đối chiếu với header X-MBX-USED-WEIGHT-1M / X-MBX-ORDER-COUNT-* sau mỗi phản hồi.
+    Khóa chỉ giữ trong lúc cập nhật bộ đếm nên các request rẻ chạy song song được.
+    """
+
+    def __init__(
+        self,
+        weight_limit=_REQUEST_WEIGHT_LIMIT_1M,
+        order_limit_10s=_ORDER_LIMIT_10S,
+        order_limit_1m=_ORDER_LIMIT_1M,
+        safety=_RATE_LIMIT_SAFETY,
+        max_concurrent=_MAX_CONCURRENT_REQUESTS,
+        scan_max_wait=_SCAN_MAX_WAIT,
+    ):
+        self.weight_limit = int(weight_limit * safety)
+        self.order_limit_10s = int(order_limit_10s * safety)
+        self.order_limit_1m = int(order_limit_1m * safety)
+        self.max_concurrent = max_concurrent
+        self.scan_max_wait = scan_max_wait
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._minute = 0
+        self._ten_seconds = 0
+        self._weight_used = 0
+        self._orders_10s = 0
+        self._orders_1m = 0
+        self._in_flight = 0
+        self._waiting = defaultdict(int)  # priority -> số luồng đang chờ
+        self._shed_count = 0
+
+    def _roll_windows(self, now):
+        minute = int(now // 60)
+        if minute != self._minute:
+            self._minute = minute
+            self._weight_used = 0
+            self._orders_1m = 0
+        ten_seconds = int(now // 10)
+        if ten_seconds != self._ten_seconds:
+            self._ten_seconds = ten_seconds
+            self._orders_10s = 0
+
+    def _wait_time(self, now, weight, is_order, priority):
+        """Thời gian cần chờ ngân sách trước khi request được phép đi (0 nếu đi ngay)"""
+        wait = 0
+        budget = self.weight_limit * _PRIORITY_BUDGET_SHARE.get(priority, 1.0)
+        if self._weight_used + weight > budget:
+            wait = max(wait, 60 - now % 60)
+        if is_order:
+            if self._orders_1m + 1 > self.order_limit_1m:
+                wait = max(wait, 60 - now % 60)
+            if self._orders_10s + 1 > self.order_limit_10s:
+                wait = max(wait, 10 - now % 10)
+        return wait
+
+    def _has_higher_waiters(self, priority):
+        return any(
+            count > 0 for lane, count in self._waiting.items() if lane < priority
+        )
+
+    def acquire(self, weight=1, is_order=False, priority=PRIORITY_SCAN):
+        """Chờ tới lượt. Trả về False nếu request ưu tiên thấp bị bỏ do quá tải"""
+        start = time.time()
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = time.time()
+                    self._roll_windows(now)
+                    wait = self._wait_time(now, weight, is_order, priority)
+                    if (
+                        wait <= 0
+                        and self._in_flight < self.max_concurrent
+                        and not self._has_higher_waiters(priority)
+                    ):
+                        self._weight_used += weight
+                        self._in_flight += 1
+                        if is_order:
+                            self._orders_10s += 1
+                            self._orders_1m += 1
+                        return True
+
+                    if priority >= PRIORITY_SCAN and now - start >= self.scan_max_wait:
+                        self._shed_count += 1
+                        return False
+
+                    self._cond.wait(min(wait, 0.5) if wait > 0 else 0.5)
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            self._cond.notify_all()
+
+    def update_from_headers(self, headers):
+        """Đồng bộ bộ đếm với số liệu server trả về"""
+        if not headers:
+            return
+        try:
+            used_weight = headers.get("X-MBX-USED-WEIGHT-1M")
+            orders_10s = headers.get("X-MBX-ORDER-COUNT-10S")
+            orders_1m = headers.get("X-MBX-ORDER-COUNT-1M")
+            with self._lock:
+                self._roll_windows(time.time())
+                if used_weight is not None:
+                    self._weight_used = max(self._weight_used, int(used_weight))
+                if orders_10s is not None:
+                    self._orders_10s = max(self._orders_10s, int(orders_10s))
+                if orders_1m is not None:
+                    self._orders_1m = max(self._orders_1m, int(orders_1m))
+        except (TypeError, ValueError) as e:
+            logger.error(f"Lỗi đọc header rate limit: {str(e)}")
+
+    def mark_exhausted(self):
+        """Khi bị 429, coi như đã hết ngân sách weight của phút hiện tại"""
+        with self._lock:
+            self._roll_windows(time.time())
+            self._weight_used = max(self._weight_used, self.weight_limit)
+
+    def get_usage(self):
+        with self._lock:
+            self._roll_windows(time.time())
+            return {
+                "weight_used": self._weight_used,
+                "weight_limit": self.weight_limit,
+                "orders_10s": self._orders_10s,
+                "orders_1m": self._orders_1m,
+                "in_flight": self._in_flight,
+                "waiting": dict(self._waiting),
+                "shed": self._shed_count,
+            }
+
+
+_RATE_LIMITER = BinanceRateLimiter()
 
 
 def sign(query, api_secret):
@@ -338,410 +637,2007 @@ def get_binance_server_time():
     return int(time.time() * 1000)
 
 
-def get_synchronized_timestamp():
-    """Tạo timestamp đã đồng bộ với server Binance"""
-    server_time = get_binance_server_time()
-    local_time = int(time.time() * 1000)
-    
-    # Tính offset
-    offset = server_time - local_time
-    
-    # Trả về timestamp đã điều chỉnh
-    return int(time.time() * 1000) + offset
+class ServerClock:
+    """
+    Ước lượng độ lệch đồng hồ với server Binance ở luồng nền:
+      - offset lấy theo điểm giữa RTT của mẫu có RTT nhỏ nhất
+      - độ trôi (drift) ước lượng bằng hồi quy tuyến tính trên các mẫu gần nhất
+    now_ms() chỉ đọc một tuple bất biến nên không cần khóa.
+    """
 
+    def __init__(self, sync_interval=_CLOCK_SYNC_INTERVAL, max_samples=_CLOCK_MAX_SAMPLES):
+        self.sync_interval = sync_interval
+        self._samples = deque(maxlen=max_samples)  # (local_mid_ms, offset_ms, rtt_ms)
+        self._estimate = (0.0, 0.0, time.time() * 1000)  # (offset_ms, drift, ref_ms)
+        self._lock = threading.Lock()
+        self._resync_event = threading.Event()
+        self._first_sample_done = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        t0 = time.time() * 1000
+        data = binance_api_request("https://fapi.binance.com/fapi/v1/time")
+        t1 = time.time() * 1000
+        if not data or "serverTime" not in data:
+            return False
 
-def binance_api_request(url, method="GET", params=None, headers=None, retry_count=3):
-    """Hàm gọi API với retry và quản lý rate limit tốt hơn"""
-    max_retries = retry_count
-    base_url = url
+        local_mid = (t0 + t1) / 2
+        offset = float(data["serverTime"]) - local_mid
+        with self._lock:
+            self._samples.append((local_mid, offset, t1 - t0))
+            self._estimate = self._compute_estimate()
+        return True
 
-    for attempt in range(max_retries):
+    def _compute_estimate(self):
+        samples = list(self._samples)
+        ref_ms, offset, _ = min(samples, key=lambda s: s[2])
+
+        drift = 0.0
+        if len(samples) >= 3:
+            mean_x = sum(s[0] for s in samples) / len(samples)
+            mean_y = sum(s[1] for s in samples) / len(samples)
+            var_x = sum((s[0] - mean_x) ** 2 for s in samples)
+            if var_x > 0:
+                cov = sum((s[0] - mean_x) * (s[1] - mean_y) for s in samples)
+                drift = max(-_CLOCK_MAX_DRIFT, min(_CLOCK_MAX_DRIFT, cov / var_x))
+        return (offset, drift, ref_ms)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None:
+                started_by_other = True
+            else:
+                started_by_other = False
+                self._thread = threading.Thread(target=self._run, daemon=True)
+        if started_by_other:
+            self._first_sample_done.wait(5)
+            return
+        # Lấy mẫu đầu tiên đồng bộ để request ký đầu tiên đã có offset đúng
         try:
-            _wait_for_rate_limit()
-            url = base_url
-
-            if headers is None:
-                headers = {}
-            if "User-Agent" not in headers:
-                headers["User-Agent"] = (
-                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-                )
+            self._sample()
+        finally:
+            self._first_sample_done.set()
+            self._thread.start()
 
-            if method.upper() == "GET":
-                if params:
-                    query = urllib.parse.urlencode(params)
-                    url = f"{url}?{query}"
-                req = urllib.request.Request(url, headers=headers)
-            else:
-                data = urllib.parse.urlencode(params).encode() if params else None
-                req = urllib.request.Request(
-                    url, data=data, headers=headers, method=method
-                )
+    def _run(self):
+        while True:
+            # Chưa có mẫu nào (lần lấy trước lỗi) thì thử lại sớm hơn
+            self._resync_event.wait(self.sync_interval if self._samples else 5)
+            self._resync_event.clear()
+            try:
+                self._sample()
+            except Exception as e:
+                logger.error(f"Lỗi đồng bộ thời gian server: {str(e)}")
 
-            with urllib.request.urlopen(req, timeout=20) as response:
-                if response.status == 200:
-                    return json.loads(response.read().decode())
-                else:
-                    error_content = response.read().decode()
-                    # LOG CHI TIẾT CHO BAD REQUEST (400)
-                    if response.status == 400:
-                        logger.error(f"❌❌❌ BAD REQUEST (400) CHI TIẾT: {error_content}")
-                        logger.error(f"URL: {url}")
-                        logger.error(f"Method: {method}")
-                        logger.error(f"Params: {params}")
-                        logger.error(f"Headers: {headers}")
-                    else:
-                        logger.error(f"Lỗi API ({response.status}): {error_content}")
-                    
-                    if response.status == 401:
-                        return None
-                    if response.status == 429:
-                        sleep_time = 2**attempt + 1
-                        logger.warning(f"⚠️ 429 Quá nhiều yêu cầu, đợi {sleep_time}s")
-                        time.sleep(sleep_time)
-                        continue
-                    elif response.status >= 500:
-                        time.sleep(1)
-                        continue
-                    return None
+    def request_resync(self):
+        """Bỏ các mẫu cũ và lấy mẫu mới ngay (gọi khi gặp lỗi -1021)"""
+        with self._lock:
+            self._samples.clear()
+        self._resync_event.set()
 
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode() if e.read() else ""
-            
-            # LOG CHI TIẾT CHO BAD REQUEST (400)
-            if e.code == 400:
-                logger.error(f"❌❌❌ HTTP BAD REQUEST (400) CHI TIẾT: {error_body}")
-                logger.error(f"URL: {url}")
-                logger.error(f"Method: {method}")
-                logger.error(f"Params: {params}")
-                logger.error(f"Headers: {headers}")
-                logger.error(f"Reason: {e.reason}")
-            elif e.code == 451:
-                logger.error("❌ Lỗi 451: Truy cập bị chặn - Kiểm tra VPN/proxy")
-                return None
-            else:
-                logger.error(f"Lỗi HTTP ({e.code}): {e.reason} - {error_body}")
+    def now_ms(self):
+        if not self._first_sample_done.is_set():
+            self._ensure_started()
+        offset, drift, ref_ms = self._estimate
+        now = time.time() * 1000
+        return int(now + offset + drift * (now - ref_ms))
 
-            if e.code == 401:
-                return None
-            if e.code == 429:
-                sleep_time = 2**attempt + 1
-                logger.warning(f"⚠️ HTTP 429 Quá nhiều yêu cầu, đợi {sleep_time}s")
-                time.sleep(sleep_time)
-                continue
-            elif e.code >= 500:
-                time.sleep(1)
-                continue
-            return None
+    def get_offset_info(self):
+        offset, drift, ref_ms = self._estimate
+        return {"offset_ms": offset, "drift": drift, "samples": len(self._samples)}
 
-        except Exception as e:
-            global _LAST_API_ERROR_LOG_TIME
-            current_time = time.time()
-            if current_time - _LAST_API_ERROR_LOG_TIME > _API_ERROR_LOG_INTERVAL:
-                logger.error(f"Lỗi kết nối API (lần thử {attempt + 1}): {str(e)}")
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                _LAST_API_ERROR_LOG_TIME = current_time
-            time.sleep(1)
 
-    logger.error(f"❌ Thất bại yêu cầu API sau {max_retries} lần thử")
-    logger.error(f"URL cuối cùng: {url}")
-    logger.error(f"Method: {method}")
-    logger.error(f"Params: {params}")
-    return None
+_SERVER_CLOCK = ServerClock()
 
 
-def adjust_leverage_to_valid_range(symbol, desired_leverage, api_key, api_secret):
-    """
-    Điều chỉnh leverage về giá trị hợp lệ với symbol
-    """
-    try:
-        max_leverage = get_max_leverage(symbol, api_key, api_secret)
-        
-        if desired_leverage > max_leverage:
-            logger.warning(f"⚠️ {symbol}: Leverage {desired_leverage}x > max {max_leverage}x, điều chỉnh xuống {max_leverage}x")
-            return max_leverage
-        
-        return desired_leverage
-    except Exception as e:
-        logger.error(f"❌ Lỗi kiểm tra leverage {symbol}: {str(e)}")
-        return min(desired_leverage, 25)  # Fallback an toàn
+def get_synchronized_timestamp():
+    """Tạo timestamp đã đồng bộ với server Binance (dùng offset đã cache)"""
+    return _SERVER_CLOCK.now_ms()
 
 
-def get_all_usdt_pairs(limit=50):
-    global _USDT_CACHE
-    try:
-        now = time.time()
-        if _USDT_CACHE["cặp"] and (now - _USDT_CACHE["cập_nhật_cuối"] < _USDT_CACHE_TTL):
-            return _USDT_CACHE["cặp"][:limit]
+def json_loads(data):
+    """Giải mã JSON trực tiếp từ bytes/str, dùng orjson nếu có cài"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
-        url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
-        data = binance_api_request(url)
-        if not data:
-            return []
 
-        usdt_pairs = []
-        for symbol_info in data.get("symbols", []):
-            symbol = symbol_info.get("symbol", "")
-            if (
-                symbol.endswith("USDT")
-                and symbol_info.get("status") == "TRADING"
-                and symbol not in _SYMBOL_BLACKLIST
-            ):
-                usdt_pairs.append(symbol)
+_JSON_FIELD_PATTERNS = {}
 
-        _USDT_CACHE["cặp"] = usdt_pairs
-        _USDT_CACHE["cập_nhật_cuối"] = now
-        logger.info(f"✅ Đã lấy {len(usdt_pairs)} cặp USDT (loại trừ BTC/ETH)")
-        return usdt_pairs[:limit]
 
-    except Exception as e:
-        logger.error(f"❌ Lỗi lấy danh sách coin: {str(e)}")
-        return []
+def extract_json_fields(message, fields):
+    """
+    Lấy nhanh giá trị các trường vô hướng (chuỗi/số) từ frame JSON phẳng
+    mà không giải mã toàn bộ. Trả về None nếu thiếu trường để bên gọi
+    chuyển sang giải mã đầy đủ.
+    """
+    values = []
+    for field in fields:
+        pattern = _JSON_FIELD_PATTERNS.get(field)
+        if pattern is None:
+            pattern = re.compile(r'"%s":\s*"?([^",}\s]+)' % re.escape(field))
+            _JSON_FIELD_PATTERNS[field] = pattern
+        match = pattern.search(message)
+        if match is None:
+            return None
+        values.append(match.group(1))
+    return values
 
 
-def get_ticker_24h_data():
-    """Lấy dữ liệu 24h cho tất cả các symbol và cache lại"""
-    global _VOLUME_CACHE
-    try:
-        now = time.time()
-        if _VOLUME_CACHE["dữ_liệu"] and (now - _VOLUME_CACHE["cập_nhật_cuối"] < _VOLUME_CACHE_TTL):
-            return _VOLUME_CACHE["dữ_liệu"]
-        
-        url = "https://fapi.binance.com/fapi/v1/ticker/24hr"
-        data = binance_api_request(url)
-        if not data:
-            return []
-        
-        _VOLUME_CACHE["dữ_liệu"] = data
-        _VOLUME_CACHE["cập_nhật_cuối"] = now
-        logger.info(f"✅ Đã lấy dữ liệu 24h cho {len(data)} symbol")
-        return data
-    except Exception as e:
-        logger.error(f"❌ Lỗi lấy dữ liệu 24h: {str(e)}")
-        return []
+class HttpConnectionPool:
+    """Pool kết nối HTTP keep-alive theo host, dùng chung cho tất cả luồng"""
 
+    def __init__(
+        self,
+        max_per_host=_HTTP_POOL_SIZE,
+        idle_timeout=_HTTP_POOL_IDLE_TIMEOUT,
+        timeout=_HTTP_TIMEOUT,
+    ):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)  # key -> [(conn, thời điểm dùng cuối)]
+        self._slots = {}
+        # path -> [số request, byte nhận qua mạng, byte sau giải nén]
+        self._transfer_stats = defaultdict(lambda: [0, 0, 0])
 
-def get_top_volume_symbols(limit=20, min_volume_usdt=_MIN_VOLUME_USDT):
-    """Lấy top coin có khối lượng giao dịch cao nhất (USDT) với bộ lọc volume"""
-    try:
-        ticker_data = get_ticker_24h_data()
-        if not ticker_data:
-            return []
+    def _get_slots(self, key):
+        with self._lock:
+            slots = self._slots.get(key)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_per_host)
+                self._slots[key] = slots
+            return slots
 
-        volume_data = []
-        for item in ticker_data:
-            symbol = item.get("symbol", "")
-            if symbol.endswith("USDT") and symbol not in _SYMBOL_BLACKLIST:
-                volume = float(item.get("quoteVolume", 0))
-                if volume >= min_volume_usdt:
-                    volume_data.append((symbol, volume))
+    def _checkout(self, key):
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
 
-        volume_data.sort(key=lambda x: x[1], reverse=True)
+        for old_conn in stale:
+            old_conn.close()
 
-        top_symbols = [symbol for symbol, _ in volume_data[:limit]]
+        if conn is not None:
+            return conn, True
 
-        logger.info(f"📊 Đã lấy {len(top_symbols)} coin có khối lượng cao nhất (USDT, min {min_volume_usdt:,})")
-        return top_symbols
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, port, timeout=self.timeout), False
 
-    except Exception as e:
-        logger.error(f"Lỗi lấy top volume: {str(e)}")
-        return []
+    def _checkin(self, key, conn):
+        with self._lock:
+            self._idle[key].append((conn, time.time()))
 
+    def evict_idle(self):
+        """Đóng các kết nối đã rảnh quá idle_timeout"""
+        now = time.time()
+        stale = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                fresh = []
+                for conn, last_used in idle:
+                    if now - last_used < self.idle_timeout:
+                        fresh.append((conn, last_used))
+                    else:
+                        stale.append(conn)
+                self._idle[key] = fresh
+        for conn in stale:
+            conn.close()
+        return len(stale)
+
+    @staticmethod
+    def _decompress(data, encoding):
+        encoding = (encoding or "").lower()
+        if encoding == "gzip":
+            return gzip.decompress(data)
+        if encoding == "deflate":
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # Một số server gửi deflate thô không có header zlib
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
 
-def get_high_volatility_symbols(limit=20, min_volume_usdt=_MIN_VOLUME_USDT):
-    """Lấy top coin có biến động cao nhất (USDT) dựa trên percent change"""
-    try:
-        ticker_data = get_ticker_24h_data()
-        if not ticker_data:
-            return []
+    def _record_transfer(self, path, wire_bytes, decoded_bytes):
+        with self._lock:
+            stats = self._transfer_stats[path]
+            stats[0] += 1
+            stats[1] += wire_bytes
+            stats[2] += decoded_bytes
 
-        volatility_data = []
-        for item in ticker_data:
-            symbol = item.get("symbol", "")
-            if symbol.endswith("USDT") and symbol not in _SYMBOL_BLACKLIST:
-                volume = float(item.get("quoteVolume", 0))
-                price_change = abs(float(item.get("priceChangePercent", 0)))
-                
-                if volume >= min_volume_usdt:
-                    volatility_data.append((symbol, price_change))
+    def get_transfer_stats(self):
+        """Thống kê byte theo endpoint, cho biết lượng băng thông tiết kiệm nhờ nén"""
+        with self._lock:
+            return {
+                path: {
+                    "requests": requests_count,
+                    "wire_bytes": wire_bytes,
+                    "decoded_bytes": decoded_bytes,
+                    "saved_bytes": decoded_bytes - wire_bytes,
+                }
+                for path, (requests_count, wire_bytes, decoded_bytes) in self._transfer_stats.items()
+            }
 
-        volatility_data.sort(key=lambda x: x[1], reverse=True)
+    @staticmethod
+    def _is_stale_socket_error(error, sent):
+        """
+        Lỗi khi GỬI trên socket keep-alive đã bị server đóng (request chưa ra khỏi máy).
+        Đã gửi xong thì server có thể đã xử lý: không bao giờ coi là an toàn để gửi lại.
+        """
+        if sent or isinstance(error, TimeoutError):
+            return False
+        return isinstance(error, (BrokenPipeError, ConnectionResetError))
+
+    def request(self, method, url, body=None, headers=None):
+        """Gửi request qua kết nối trong pool, trả về (status, reason, headers, body).
+        Tự yêu cầu nén gzip/deflate và giải nén phản hồi."""
+        headers = dict(headers or {})
+        headers.setdefault("Accept-Encoding", "gzip, deflate")
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or "https"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        slots = self._get_slots(key)
+        slots.acquire()
+        try:
+            for attempt in range(2):
+                conn, reused = self._checkout(key)
+                sent = False
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    sent = True
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    conn.close()
+                    # Kết nối keep-alive cũ có thể đã bị server đóng, thử lại với kết nối mới.
+                    # Không gửi lại POST (đặt lệnh) trừ khi chắc server chưa nhận request
+                    if reused and attempt == 0 and (
+                        method in _IDEMPOTENT_METHODS or self._is_stale_socket_error(e, sent)
+                    ):
+                        continue
+                    raise
 
-        top_symbols = [symbol for symbol, _ in volatility_data[:limit]]
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._checkin(key, conn)
 
-        logger.info(f"📈 Đã lấy {len(top_symbols)} coin có biến động cao nhất (USDT)")
-        return top_symbols
+                decoded = self._decompress(data, response.getheader("Content-Encoding"))
+                self._record_transfer(parts.path, len(data), len(decoded))
+                return response.status, response.reason, response.headers, decoded
+        finally:
+            slots.release()
 
-    except Exception as e:
-        logger.error(f"Lỗi lấy high volatility: {str(e)}")
-        return []
 
+_HTTP_POOL = HttpConnectionPool()
 
-def get_best_trending_symbols(limit=15, min_volume_usdt=_MIN_VOLUME_USDT):
+
+class CircuitBreaker:
     """
-    Lấy coin có xu hướng tốt nhất dựa trên:
-    1. Volume cao
-    2. Biến động vừa phải (2-10%)
-    3. Xu hướng rõ ràng (price change dương/âm mạnh)
+    Ngắt mạch dùng chung cho mọi luồng khi Binance đẩy ngược (429/418/5xx):
+      - 429, 418 hoặc nhiều lỗi 5xx liên tiếp → mở mạch, tôn trọng Retry-After
+      - thời gian mở mạch tăng theo backoff decorrelated jitter
+      - khi mở: request quét bị từ chối ngay, request ưu tiên cao chờ mạch đóng
+        (tối đa max_wait rồi được đi tiếp, trừ khi đang bị cấm IP 418)
+      - hết thời gian mở: cho đúng 1 request thăm dò (half-open); chỉ request
+        thăm dò thành công mới đóng mạch
     """
-    try:
-        ticker_data = get_ticker_24h_data()
-        if not ticker_data:
-            return []
-
-        scored_symbols = []
-        for item in ticker_data:
-            symbol = item.get("symbol", "")
-            if symbol.endswith("USDT") and symbol not in _SYMBOL_BLACKLIST:
-                volume = float(item.get("quoteVolume", 0))
-                price_change = float(item.get("priceChangePercent", 0))
-                high_price = float(item.get("highPrice", 0))
-                low_price = float(item.get("lowPrice", 0))
-                
-                # Bỏ qua coin giá quá thấp
-                if high_price < _MIN_PRICE:
-                    continue
-                    
-                # Tính spread
-                if low_price > 0:
-                    spread_percent = ((high_price - low_price) / low_price) * 100
-                else:
-                    spread_percent = 0
-                
-                # Điều kiện lọc
-                if (volume >= min_volume_usdt and 
-                    2 <= abs(price_change) <= 15 and  # Biến động vừa phải
-                    spread_percent <= _MAX_SPREAD_PERCENT):  # Spread không quá cao
-                    
-                    # Tính điểm dựa trên volume và độ mạnh của trend
-                    volume_score = math.log10(volume) / 10
-                    trend_strength = abs(price_change) / 10
-                    total_score = volume_score * 0.6 + trend_strength * 0.4
-                    
-                    scored_symbols.append((symbol, total_score, price_change))
 
-        scored_symbols.sort(key=lambda x: x[1], reverse=True)
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
 
-        top_symbols = [symbol for symbol, score, change in scored_symbols[:limit]]
+    def __init__(
+        self,
+        failure_threshold=_BREAKER_FAILURE_THRESHOLD,
+        failure_window=_BREAKER_FAILURE_WINDOW,
+        base_delay=_BREAKER_BASE_DELAY,
+        max_delay=_BREAKER_MAX_DELAY,
+        max_wait=_BREAKER_MAX_WAIT,
+    ):
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.state = self.CLOSED
+        self.trip_count = 0
+        self._cond = threading.Condition()
+        self._failures = deque()
+        self._open_until = 0
+        self._delay = base_delay
+        self._probe_in_flight = False
+        self._probe_started = 0
+        self._probe_thread = None
+        self._banned = False  # Mở do 418: không lane nào được đi trước _open_until
+
+    def backoff_delay(self, previous=None):
+        """Decorrelated jitter: ngẫu nhiên trong [base, previous * 3], chặn trên max_delay"""
+        previous = previous or self.base_delay
+        return min(self.max_delay, random.uniform(self.base_delay, previous * 3))
+
+    def allow_request(self, priority):
+        """Trả về False nếu request bị từ chối do mạch đang mở"""
+        deadline = time.time() + self.max_wait
+        with self._cond:
+            while True:
+                now = time.time()
+                if self.state == self.CLOSED:
+                    return True
+                if self.state == self.OPEN and now >= self._open_until:
+                    self.state = self.HALF_OPEN
+                    self._probe_in_flight = False
+                if self.state == self.HALF_OPEN and (
+                    not self._probe_in_flight
+                    or now - self._probe_started > _HTTP_TIMEOUT
+                ):
+                    # Request thăm dò bị treo/bỏ giữa chừng thì cho request khác thăm dò
+                    self._probe_in_flight = True
+                    self._probe_started = now
+                    self._probe_thread = threading.get_ident()
+                    return True
+                if priority >= PRIORITY_SCAN:
+                    return False
+                if now >= deadline:
+                    if self._banned and self.state == self.OPEN:
+                        # Đang bị cấm IP: gửi thêm chỉ kéo dài lệnh cấm
+                        return False
+                    # Không chặn lệnh/đọc vị thế quá lâu
+                    return True
+                wait = self._open_until - now if self.state == self.OPEN else 0.5
+                self._cond.wait(max(0.05, min(wait, deadline - now)))
 
-        if top_symbols:
+    def record_success(self):
+        with self._cond:
+            if self.state == self.CLOSED:
+                return
+            # Request đi vòng khi mạch mở không chứng minh được Binance đã ổn
+            if self.state != self.HALF_OPEN or self._probe_thread != threading.get_ident():
+                return
+            self.state = self.CLOSED
+            self._delay = self.base_delay
+            self._failures.clear()
+            self._probe_in_flight = False
+            self._probe_thread = None
+            self._banned = False
+            self._cond.notify_all()
+        logger.warning("✅ Binance đã phản hồi bình thường, đóng mạch")
+
+    def record_failure(self, status=None, retry_after=None):
+        """status=None là lỗi kết nối: chỉ tính khi đang thăm dò (half-open)"""
+        with self._cond:
+            now = time.time()
+            if status is None:
+                if self.state != self.HALF_OPEN:
+                    return False
+            else:
+                self._failures.append(now)
+                while self._failures and now - self._failures[0] > self.failure_window:
+                    self._failures.popleft()
+
+            should_trip = (
+                self.state == self.HALF_OPEN
+                or status in (418, 429)
+                or retry_after
+                or len(self._failures) >= self.failure_threshold
+            )
+            if not should_trip:
+                return False
+
+            self._delay = self.backoff_delay(self._delay)
+            duration = max(self._delay, retry_after or 0)
+            if status == 418:
+                duration = max(duration, _BREAKER_BAN_DELAY)
+            self._banned = status == 418
+            self._open_until = now + duration
+            self.state = self.OPEN
+            self._probe_in_flight = False
+            self._probe_thread = None
+            self.trip_count += 1
+            self._cond.notify_all()
+
+        logger.warning(
+            f"⚠️ Ngắt mạch API Binance {duration:.1f}s (HTTP {status}, lần {self.trip_count})"
+        )
+        return True
+
+    def get_status(self):
+        with self._cond:
+            return {
+                "state": self.state,
+                "open_for": max(0.0, self._open_until - time.time()),
+                "trip_count": self.trip_count,
+            }
+
+
+_CIRCUIT_BREAKER = CircuitBreaker()
+
+
+class LatencyHistogram:
+    """Histogram kiểu HDR: bucket logarit nên sai số tương đối cố định, bộ nhớ nhỏ"""
+
+    def __init__(self, precision=_HISTOGRAM_PRECISION):
+        self._log_base = math.log(1 + precision)
+        self._buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = max(float(value), 0.0)
+        index = int(math.log(value) / self._log_base) if value >= 1 else 0
+        self._buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        target = q / 100 * self.count
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= target:
+                return min(math.exp((index + 1) * self._log_base), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max or 0.0,
+        }
+
+
+class RestMetrics:
+    """Thống kê theo endpoint: thời gian chờ hàng đợi, thời gian mạng, kích thước phản hồi,
+    mã trạng thái, số lần retry và weight đã dùng"""
+
+    def __init__(self, log_interval=_REST_METRICS_LOG_INTERVAL):
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._last_log_time = time.time()
+
+    def _get_endpoint(self, path):
+        stats = self._endpoints.get(path)
+        if stats is None:
+            stats = {
+                "queue_wait_ms": LatencyHistogram(),
+                "network_ms": LatencyHistogram(),
+                "response_bytes": LatencyHistogram(),
+                "statuses": defaultdict(int),
+                "retries": 0,
+                "weight": 0,
+            }
+            self._endpoints[path] = stats
+        return stats
+
+    def record(
+        self,
+        path,
+        status,
+        queue_wait=0.0,
+        network_time=None,
+        response_size=None,
+        weight=0,
+        retry=False,
+    ):
+        with self._lock:
+            stats = self._get_endpoint(path)
+            stats["statuses"][status] += 1
+            stats["queue_wait_ms"].record(queue_wait * 1000)
+            if network_time is not None:
+                stats["network_ms"].record(network_time * 1000)
+                stats["weight"] += weight
+            if response_size is not None:
+                stats["response_bytes"].record(response_size)
+            if retry:
+                stats["retries"] += 1
+        self.maybe_log_summary()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                path: {
+                    "queue_wait_ms": stats["queue_wait_ms"].summary(),
+                    "network_ms": stats["network_ms"].summary(),
+                    "response_bytes": stats["response_bytes"].summary(),
+                    "statuses": dict(stats["statuses"]),
+                    "retries": stats["retries"],
+                    "weight": stats["weight"],
+                }
+                for path, stats in self._endpoints.items()
+            }
+
+    def format_summary(self):
+        lines = ["📊 Thống kê REST theo endpoint:"]
+        for path, stats in sorted(self.snapshot().items()):
+            network = stats["network_ms"]
+            queue_wait = stats["queue_wait_ms"]
+            lines.append(
+                f"• {path}: {network['count']} req | weight {stats['weight']} | "
+                f"mạng p50/p99 {network['p50']:.0f}/{network['p99']:.0f}ms | "
+                f"chờ p99 {queue_wait['p99']:.0f}ms | "
+                f"{stats['response_bytes']['mean']:.0f}B/req | retry {stats['retries']} | "
+                f"mã {stats['statuses']}"
+            )
+        return "\n".join(lines)
+
+    def maybe_log_summary(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_log_time < self.log_interval:
+                return
+            self._last_log_time = now
+        logger.info(self.format_summary())
+
+
+_REST_METRICS = RestMetrics()
+
+
+def get_rest_metrics():
+    """Số liệu REST theo endpoint (dùng để tinh chỉnh rate limit, cache...)"""
+    return _REST_METRICS.snapshot()
+
+
+# Vị trí gọi API dùng để phân bổ chi phí theo bot
+CALL_SITE_SCAN = "scan"
+CALL_SITE_POSITION = "position"
+CALL_SITE_MARGIN = "margin"
+CALL_SITE_ORDER = "order"
+CALL_SITE_OTHER = "other"
+
+_API_CALL_CONTEXT = threading.local()
+
+
+@contextmanager
+def api_call_context(bot_id=None, site=None):
+    """Gắn bot_id và vị trí gọi cho mọi REST call trong khối with (theo từng luồng)"""
+    previous = (
+        getattr(_API_CALL_CONTEXT, "bot_id", None),
+        getattr(_API_CALL_CONTEXT, "site", None),
+    )
+    _API_CALL_CONTEXT.bot_id = bot_id if bot_id is not None else previous[0]
+    _API_CALL_CONTEXT.site = site if site is not None else previous[1]
+    try:
+        yield
+    finally:
+        _API_CALL_CONTEXT.bot_id, _API_CALL_CONTEXT.site = previous
+
+
+def track_api_cost(site):
+    """Decorator cho phương thức của bot: gắn self.bot_id và vị trí gọi vào REST call bên trong"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with api_call_context(getattr(self, "bot_id", None), site):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class ApiCostTracker:
+    """Cộng dồn số request, weight và thời gian theo bot và vị trí gọi"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._costs = {}  # bot_id -> {site -> [requests, weight, wall_time]}
+        self.start_time = time.time()
+
+    def record(self, weight, wall_time):
+        bot_id = getattr(_API_CALL_CONTEXT, "bot_id", None) or "HỆ THỐNG"
+        site = getattr(_API_CALL_CONTEXT, "site", None) or CALL_SITE_OTHER
+        with self._lock:
+            sites = self._costs.setdefault(bot_id, {})
+            cost = sites.setdefault(site, [0, 0, 0.0])
+            cost[0] += 1
+            cost[1] += weight
+            cost[2] += wall_time
+
+    def snapshot(self):
+        """bot_id -> {requests, weight, wall_time, sites: {site: {...}}}"""
+        with self._lock:
+            result = {}
+            for bot_id, sites in self._costs.items():
+                site_costs = {
+                    site: {"requests": c[0], "weight": c[1], "wall_time": c[2]}
+                    for site, c in sites.items()
+                }
+                result[bot_id] = {
+                    "requests": sum(c[0] for c in sites.values()),
+                    "weight": sum(c[1] for c in sites.values()),
+                    "wall_time": sum(c[2] for c in sites.values()),
+                    "sites": site_costs,
+                }
+            return result
+
+
+_API_COSTS = ApiCostTracker()
+
+
+def get_api_costs():
+    return _API_COSTS.snapshot()
+
+
+class NegativeSymbolCache:
+    """
+    Nhớ các symbol vừa lỗi theo (symbol, loại lỗi) để lần quét sau bỏ qua mà
+    không tốn request. Thời gian chặn tăng theo cấp số nhân với mỗi lần lỗi liên
+    tiếp; số lần lỗi được quên khi hết chặn mà không lỗi lại trong một chu kỳ.
+    """
+
+    def __init__(
+        self,
+        base_ttl=_NEGATIVE_CACHE_BASE_TTL,
+        max_ttl=_NEGATIVE_CACHE_MAX_TTL,
+        max_size=_NEGATIVE_CACHE_MAX_SIZE,
+    ):
+        self.base_ttl = base_ttl
+        self.max_ttl = max_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (symbol, loại lỗi) -> (hết chặn lúc, số lần lỗi)
+        self._lock = threading.Lock()
+
+    def record_failure(self, symbol, failure_class, reason=""):
+        if not symbol:
+            return 0
+        key = (symbol.upper(), failure_class)
+        now = time.time()
+        with self._lock:
+            expires_at, strikes = self._entries.pop(key, (0, 0))
+            # Hết chặn đã lâu (quá một chu kỳ) thì tính lại từ đầu
+            if strikes and now > expires_at + self._ttl_for(strikes):
+                strikes = 0
+            strikes += 1
+            ttl = self._ttl_for(strikes)
+            self._entries[key] = (now + ttl, strikes)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        # Spread cao gặp ở phần lớn coin mỗi lần quét: không ghi vào log lỗi
+        log = logger.debug if failure_class == FAILURE_HIGH_SPREAD else logger.warning
+        log(
+            f"⛔ {key[0]}: tạm bỏ qua {ttl / 60:.0f} phút ({failure_class}, lần {strikes})"
+            + (f" - {reason}" if reason else "")
+        )
+        return ttl
+
+    def _ttl_for(self, strikes):
+        return min(self.base_ttl * (2 ** (strikes - 1)), self.max_ttl)
+
+    def blocked_reason(self, symbol):
+        """Loại lỗi đang chặn symbol, hoặc None"""
+        if not symbol:
+            return None
+        symbol = symbol.upper()
+        now = time.time()
+        with self._lock:
+            for failure_class in (FAILURE_LEVERAGE, FAILURE_KLINES, FAILURE_ORDER, FAILURE_HIGH_SPREAD):
+                entry = self._entries.get((symbol, failure_class))
+                if entry is None:
+                    continue
+                if now < entry[0]:
+                    return failure_class
+        return None
+
+    def is_blocked(self, symbol):
+        return self.blocked_reason(symbol) is not None
+
+    def clear(self, symbol, failure_class=None):
+        """Xóa chặn (vd. khi thao tác lại thành công)"""
+        symbol = symbol.upper()
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == symbol and failure_class in (None, key[1]):
+                    del self._entries[key]
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {
+                f"{symbol}:{failure_class}": {"remaining": expires_at - now, "strikes": strikes}
+                for (symbol, failure_class), (expires_at, strikes) in self._entries.items()
+                if expires_at > now
+            }
+
+
+_NEGATIVE_CACHE = NegativeSymbolCache()
+
+
+def get_negative_cache():
+    return _NEGATIVE_CACHE
+
+
+def _is_symbol_level_error(response):
+    """Phản hồi lỗi của sàn có phải do chính symbol (không phải do tài khoản)?"""
+    try:
+        return int(response.get("code", 0)) not in _ACCOUNT_LEVEL_ERROR_CODES
+    except (TypeError, ValueError, AttributeError):
+        return True
+
+
+class SingleFlight:
+    """Gộp các lời gọi giống hệt nhau đang chạy đồng thời: chỉ một lời gọi chạy thật,
+    các luồng còn lại chờ và nhận cùng kết quả"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared_count = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+            else:
+                self.shared_count += 1
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+        return call["result"]
+
+
+_REQUEST_FLIGHTS = SingleFlight()
+
+# Giá trị đánh dấu "không có trong cache" (None vẫn là giá trị hợp lệ để cache)
+_CACHE_MISS = object()
+
+
+class TTLCache:
+    """
+    Cache dùng chung: TTL theo từng key, giới hạn kích thước theo LRU, an toàn luồng.
+    - stale_ttl > 0: hết hạn nhưng chưa quá stale_ttl thì trả giá trị cũ ngay và
+      một luồng nền làm mới (stale-while-revalidate)
+    - Các luồng cùng trượt cache một key chỉ gọi loader một lần
+    - Loader trả về None nghĩa là lỗi, không lưu vào cache
+    """
+
+    def __init__(self, name, ttl, max_size=_CACHE_DEFAULT_MAX_SIZE, stale_ttl=0):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()  # key -> (giá trị, hết hạn lúc)
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._refreshing = set()
+        self._load_latency = LatencyHistogram()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_errors = 0
+        _CACHE_REGISTRY.add(self)
+
+    def _store(self, key, value, ttl):
+        self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        """Giá trị còn hạn của key, hoặc default"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and time.time() < entry[1]:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def set_many(self, items, ttl=None):
+        with self._lock:
+            for key, value in items.items():
+                self._store(key, value, ttl)
+
+    def invalidate(self, key=None):
+        """Xóa một key, hoặc toàn bộ cache nếu key là None"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def _load(self, key, loader, ttl):
+        start = time.time()
+        try:
+            value = loader()
+        except Exception:
+            with self._lock:
+                self.load_errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._load_latency.record((time.time() - start) * 1000)
+        if value is None:
+            with self._lock:
+                self.load_errors += 1
+            return None
+        with self._lock:
+            self._store(key, value, ttl)
+        return value
+
+    def _revalidate(self, key, loader, ttl):
+        try:
+            self._flight.do(key, lambda: self._load(key, loader, ttl))
+        except Exception as e:
+            logger.error(f"Lỗi làm mới cache {self.name}/{key}: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Trả giá trị trong cache, nạp bằng loader() nếu thiếu/hết hạn"""
+        with self._lock:
+            entry = self._data.get(key)
+            now = time.time()
+            if entry is not None:
+                value, expires_at = entry
+                if now < expires_at:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if now < expires_at + self.stale_ttl:
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(
+                            target=self._revalidate, args=(key, loader, ttl), daemon=True
+                        ).start()
+                    return value
+            self.misses += 1
+
+        return self._flight.do(key, lambda: self._load(key, loader, ttl))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "load_errors": self.load_errors,
+                "load_ms": self._load_latency.summary(),
+            }
+
+
+# Ảnh chụp dữ liệu bất biến: luồng đọc lấy tham chiếu mà không cần khóa
+MarketSnapshot = namedtuple("MarketSnapshot", ["data", "fetched_at"])
+
+# Tham chiếu yếu: cache của bot đã dừng tự biến mất khỏi thống kê
+_CACHE_REGISTRY = weakref.WeakSet()
+
+
+def get_cache_stats():
+    """Thống kê hit/miss/độ trễ nạp của mọi TTLCache trong tiến trình"""
+    stats = {}
+    for cache in list(_CACHE_REGISTRY):
+        name = cache.name
+        index = 1
+        while name in stats:
+            index += 1
+            name = f"{cache.name}#{index}"
+        stats[name] = cache.stats()
+    return stats
+
+# Tham số thay đổi theo từng lần ký, không dùng để nhận diện request trùng
+_VOLATILE_SIGNED_PARAMS = {"timestamp", "signature", "recvWindow"}
+
+
+def _request_flight_key(url, params=None, headers=None):
+    parts = urllib.parse.urlsplit(url)
+    _, query_params = _split_request_url(url, params)
+    stable_params = tuple(
+        sorted(
+            (k, str(v))
+            for k, v in query_params.items()
+            if k not in _VOLATILE_SIGNED_PARAMS
+        )
+    )
+    api_key = (headers or {}).get("X-MBX-APIKEY", "")
+    return (parts.netloc, parts.path, stable_params, api_key)
+
+
+def binance_api_request(
+    url, method="GET", params=None, headers=None, retry_count=3, priority=None, coalesce=True
+):
+    """Hàm gọi API với retry và quản lý rate limit tốt hơn.
+    Các GET giống hệt nhau đang chạy đồng thời được gộp thành một request.
+    coalesce=False: luôn gửi request riêng (trạng thái cần mới hơn request đang chạy)."""
+    if coalesce and method.upper() == "GET":
+        key = _request_flight_key(url, params, headers)
+        return _REQUEST_FLIGHTS.do(
+            key,
+            lambda: _send_binance_request(
+                url, method, params, headers, retry_count, priority
+            ),
+        )
+    return _send_binance_request(url, method, params, headers, retry_count, priority)
+
+
+def _send_binance_request(url, method, params, headers, retry_count, priority):
+    max_retries = retry_count
+    base_url = url
+
+    path, query_params = _split_request_url(url, params)
+    weight = get_request_weight(path, query_params)
+    is_order = method.upper() == "POST" and path in _ORDER_ENDPOINTS
+    if priority is None:
+        priority = _ENDPOINT_PRIORITIES.get(path, PRIORITY_SCAN)
+
+    retry_delay = None
+    for attempt in range(max_retries):
+        queue_start = time.time()
+        queue_wait = 0.0
+        network_start = None
+        try:
+            if not _CIRCUIT_BREAKER.allow_request(priority):
+                logger.warning(f"⚠️ Mạch API đang mở, bỏ qua request: {path}")
+                _REST_METRICS.record(path, "circuit_open", time.time() - queue_start)
+                return None
+
+            if not _RATE_LIMITER.acquire(weight, is_order, priority):
+                logger.warning(f"⚠️ Bỏ qua request ưu tiên thấp do quá tải: {path}")
+                _REST_METRICS.record(path, "shed", time.time() - queue_start)
+                return None
+
+            queue_wait = time.time() - queue_start
+            network_start = time.time()
+            try:
+                url = base_url
+
+                if headers is None:
+                    headers = {}
+                if "User-Agent" not in headers:
+                    headers["User-Agent"] = (
+                        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+                    )
+
+                body = None
+                if method.upper() == "GET":
+                    if params:
+                        query = urllib.parse.urlencode(params)
+                        url = f"{url}?{query}"
+                elif params:
+                    body = urllib.parse.urlencode(params).encode()
+                    headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+                status, reason, response_headers, content = _HTTP_POOL.request(
+                    method.upper(), url, body=body, headers=headers
+                )
+            finally:
+                _RATE_LIMITER.release()
+            _RATE_LIMITER.update_from_headers(response_headers)
+            _REST_METRICS.record(
+                path,
+                status,
+                queue_wait,
+                time.time() - network_start,
+                len(content),
+                weight,
+                retry=attempt > 0,
+            )
+            _API_COSTS.record(weight, time.time() - queue_start)
+            network_start = None
+
+            if status == 200:
+                _CIRCUIT_BREAKER.record_success()
+                return json_loads(content)
+
+            error_body = content.decode(errors="replace")
+            if status < 500 and status not in (418, 429):
+                _CIRCUIT_BREAKER.record_success()
+
+            # LOG CHI TIẾT CHO BAD REQUEST (400)
+            if status == 400:
+                logger.error(f"❌❌❌ HTTP BAD REQUEST (400) CHI TIẾT: {error_body}")
+                logger.error(f"URL: {url}")
+                logger.error(f"Method: {method}")
+                logger.error(f"Params: {params}")
+                logger.error(f"Headers: {headers}")
+                logger.error(f"Reason: {reason}")
+                if '"code":-1021' in error_body:
+                    logger.warning("⚠️ Lỗi -1021 timestamp, đang đồng bộ lại thời gian server")
+                    _SERVER_CLOCK.request_resync()
+            elif status == 451:
+                logger.error("❌ Lỗi 451: Truy cập bị chặn - Kiểm tra VPN/proxy")
+                return None
+            else:
+                logger.error(f"Lỗi HTTP ({status}): {reason} - {error_body}")
+
+            if status == 401:
+                return None
+            if status in (418, 429) or status >= 500:
+                retry_after = response_headers.get("Retry-After")
+                retry_after = int(retry_after) if retry_after and retry_after.isdigit() else None
+                if status == 429:
+                    _RATE_LIMITER.mark_exhausted()
+                    logger.warning("⚠️ HTTP 429 Quá nhiều yêu cầu")
+                tripped = _CIRCUIT_BREAKER.record_failure(status, retry_after)
+                if status == 418:
+                    logger.error("❌ HTTP 418: IP bị Binance cấm tạm thời")
+                    return None
+                if not tripped:
+                    # Mạch vẫn đóng: tự chờ ngắn có jitter, nếu đã mở thì allow_request sẽ chờ
+                    retry_delay = _CIRCUIT_BREAKER.backoff_delay(retry_delay)
+                    time.sleep(retry_delay)
+                continue
+            return None
+
+        except Exception as e:
+            _CIRCUIT_BREAKER.record_failure()
+            if network_start is not None:
+                _REST_METRICS.record(
+                    path,
+                    "error",
+                    queue_wait,
+                    time.time() - network_start,
+                    weight=weight,
+                    retry=attempt > 0,
+                )
+                _API_COSTS.record(weight, time.time() - queue_start)
+            global _LAST_API_ERROR_LOG_TIME
+            current_time = time.time()
+            if current_time - _LAST_API_ERROR_LOG_TIME > _API_ERROR_LOG_INTERVAL:
+                logger.error(f"Lỗi kết nối API (lần thử {attempt + 1}): {str(e)}")
+                logger.error(f"Traceback: {traceback.format_exc()}")
+                _LAST_API_ERROR_LOG_TIME = current_time
+            time.sleep(1)
+
+    logger.error(f"❌ Thất bại yêu cầu API sau {max_retries} lần thử")
+    logger.error(f"URL cuối cùng: {url}")
+    logger.error(f"Method: {method}")
+    logger.error(f"Params: {params}")
+    return None
+
+
+def adjust_leverage_to_valid_range(symbol, desired_leverage, api_key, api_secret, notional=0):
+    """
+    Điều chỉnh leverage về giá trị hợp lệ với symbol (theo bracket của notional dự kiến)
+    """
+    try:
+        max_leverage = get_max_leverage(symbol, api_key, api_secret, notional=notional)
+        
+        if desired_leverage > max_leverage:
+            logger.warning(f"⚠️ {symbol}: Leverage {desired_leverage}x > max {max_leverage}x, điều chỉnh xuống {max_leverage}x")
+            return max_leverage
+        
+        return desired_leverage
+    except Exception as e:
+        logger.error(f"❌ Lỗi kiểm tra leverage {symbol}: {str(e)}")
+        return min(desired_leverage, 25)  # Fallback an toàn
+
+
+def get_all_usdt_pairs(limit=50):
+    try:
+        registry = get_symbol_registry()
+        usdt_pairs = [
+            info["symbol"]
+            for info in registry.symbols()
+            if info["symbol"].endswith("USDT")
+            and info["status"] == "TRADING"
+            and info["symbol"] not in _SYMBOL_BLACKLIST
+        ]
+        logger.info(f"✅ Đã lấy {len(usdt_pairs)} cặp USDT (loại trừ BTC/ETH)")
+        return usdt_pairs[:limit]
+
+    except Exception as e:
+        logger.error(f"❌ Lỗi lấy danh sách coin: {str(e)}")
+        return []
+
+
+_TICKER_24H_CACHE = TTLCache("ticker_24h", _VOLUME_CACHE_TTL, max_size=1, stale_ttl=_VOLUME_CACHE_STALE)
+
+
+def _load_ticker_24h_data():
+    url = "https://fapi.binance.com/fapi/v1/ticker/24hr"
+    data = binance_api_request(url)
+    if not data:
+        return None
+    logger.info(f"✅ Đã lấy dữ liệu 24h cho {len(data)} symbol")
+    return data
+
+
+def get_ticker_24h_data():
+    """
+    Lấy dữ liệu 24h cho tất cả các symbol và cache lại.
+    Luôn trả về tuple các dòng chỉ đọc (MappingProxyType) dùng chung giữa các bot,
+    tuple rỗng nếu lỗi: cần sửa thì copy (dict(row) / list(...)).
+    """
+    snapshot = _MARKET_DATA.get("ticker_24h", max_age=_VOLUME_CACHE_TTL + _VOLUME_CACHE_STALE)
+    if snapshot is not None:
+        return snapshot
+    try:
+        return _TICKER_24H_CACHE.get_or_load("all", _freeze_ticker_24h) or ()
+    except Exception as e:
+        logger.error(f"❌ Lỗi lấy dữ liệu 24h: {str(e)}")
+        return ()
+
+
+def get_top_volume_symbols(limit=20, min_volume_usdt=_MIN_VOLUME_USDT):
+    """Lấy top coin có khối lượng giao dịch cao nhất (USDT) với bộ lọc volume"""
+    try:
+        ticker_data = get_ticker_24h_data()
+        if not ticker_data:
+            return []
+
+        volume_data = []
+        for item in ticker_data:
+            symbol = item.get("symbol", "")
+            if symbol.endswith("USDT") and symbol not in _SYMBOL_BLACKLIST:
+                volume = float(item.get("quoteVolume", 0))
+                if volume >= min_volume_usdt:
+                    volume_data.append((symbol, volume))
+
+        volume_data.sort(key=lambda x: x[1], reverse=True)
+
+        top_symbols = [symbol for symbol, _ in volume_data[:limit]]
+
+        logger.info(f"📊 Đã lấy {len(top_symbols)} coin có khối lượng cao nhất (USDT, min {min_volume_usdt:,})")
+        return top_symbols
+
+    except Exception as e:
+        logger.error(f"Lỗi lấy top volume: {str(e)}")
+        return []
+
+
+def get_high_volatility_symbols(limit=20, min_volume_usdt=_MIN_VOLUME_USDT):
+    """Lấy top coin có biến động cao nhất (USDT) dựa trên percent change"""
+    try:
+        ticker_data = get_ticker_24h_data()
+        if not ticker_data:
+            return []
+
+        volatility_data = []
+        for item in ticker_data:
+            symbol = item.get("symbol", "")
+            if symbol.endswith("USDT") and symbol not in _SYMBOL_BLACKLIST:
+                volume = float(item.get("quoteVolume", 0))
+                price_change = abs(float(item.get("priceChangePercent", 0)))
+                
+                if volume >= min_volume_usdt:
+                    volatility_data.append((symbol, price_change))
+
+        volatility_data.sort(key=lambda x: x[1], reverse=True)
+
+        top_symbols = [symbol for symbol, _ in volatility_data[:limit]]
+
+        logger.info(f"📈 Đã lấy {len(top_symbols)} coin có biến động cao nhất (USDT)")
+        return top_symbols
+
+    except Exception as e:
+        logger.error(f"Lỗi lấy high volatility: {str(e)}")
+        return []
+
+
+def get_best_trending_symbols(limit=15, min_volume_usdt=_MIN_VOLUME_USDT):
+    """
+    Lấy coin có xu hướng tốt nhất dựa trên:
+    1. Volume cao
+    2. Biến động vừa phải (2-10%)
+    3. Xu hướng rõ ràng (price change dương/âm mạnh)
+    """
+    try:
+        ticker_data = get_ticker_24h_data()
+        if not ticker_data:
+            return []
+
+        scored_symbols = []
+        for item in ticker_data:
+            symbol = item.get("symbol", "")
+            if symbol.endswith("USDT") and symbol not in _SYMBOL_BLACKLIST:
+                volume = float(item.get("quoteVolume", 0))
+                price_change = float(item.get("priceChangePercent", 0))
+                high_price = float(item.get("highPrice", 0))
+                low_price = float(item.get("lowPrice", 0))
+                
+                # Bỏ qua coin giá quá thấp
+                if high_price < _MIN_PRICE:
+                    continue
+                    
+                # Tính spread
+                if low_price > 0:
+                    spread_percent = ((high_price - low_price) / low_price) * 100
+                else:
+                    spread_percent = 0
+                
+                # Điều kiện lọc
+                if (volume >= min_volume_usdt and 
+                    2 <= abs(price_change) <= 15 and  # Biến động vừa phải
+                    spread_percent <= _MAX_SPREAD_PERCENT):  # Spread không quá cao
+                    
+                    # Tính điểm dựa trên volume và độ mạnh của trend
+                    volume_score = math.log10(volume) / 10
+                    trend_strength = abs(price_change) / 10
+                    total_score = volume_score * 0.6 + trend_strength * 0.4
+                    
+                    scored_symbols.append((symbol, total_score, price_change))
+
+        scored_symbols.sort(key=lambda x: x[1], reverse=True)
+
+        top_symbols = [symbol for symbol, score, change in scored_symbols[:limit]]
+
+        if top_symbols:
             logger.info(f"🎯 Đã lấy {len(top_symbols)} coin có xu hướng tốt nhất")
             
         return top_symbols
 
-    except Exception as e:
-        logger.error(f"Lỗi lấy trending symbols: {str(e)}")
-        return []
+    except Exception as e:
+        logger.error(f"Lỗi lấy trending symbols: {str(e)}")
+        return []
+
+
+class PriceTable:
+    """
+    Bảng giá theo từng symbol, mỗi giá có mốc thời gian riêng.
+    Khi thiếu/hết hạn, làm mới TOÀN BỘ symbol bằng một lời gọi không tham số
+    (/ticker/price hoặc /premiumIndex); các luồng trượt cache cùng lúc chỉ
+    kích hoạt một lần làm mới.
+    """
+
+    def __init__(self, name, url, price_field, ttl=_PRICE_CACHE_TTL):
+        self.url = url
+        self.price_field = price_field
+        self.ttl = ttl
+        self._prices = TTLCache(name, ttl, max_size=_PRICE_CACHE_MAX_SIZE)
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._last_refresh = 0
+        self._snapshot = MarketSnapshot(MappingProxyType({}), 0)
+        self.last_access = 0
+        self.refresh_count = 0
+
+    def _lookup(self, symbol):
+        # Ảnh chụp toàn bộ bảng đọc không cần khóa; giá lẻ nằm trong TTLCache
+        snapshot = self._snapshot
+        if time.time() - snapshot.fetched_at < self.ttl:
+            price = snapshot.data.get(symbol)
+            if price is not None:
+                return price
+        return self._prices.get(symbol)
+
+    def _refresh_all(self, priority=None):
+        data = binance_api_request(self.url, priority=priority)
+        if not isinstance(data, list):
+            return None
+        fresh = {}
+        for item in data:
+            try:
+                price = float(item.get(self.price_field, 0))
+            except (TypeError, ValueError):
+                continue
+            if price > 0:
+                fresh[item.get("symbol")] = price
+        self._prices.set_many(fresh)
+        now = time.time()
+        snapshot = MappingProxyType(fresh)
+        self._snapshot = MarketSnapshot(snapshot, now)
+        with self._lock:
+            self._last_refresh = now
+            self.refresh_count += 1
+        return snapshot
+
+    def refresh(self, priority=None):
+        """Làm mới toàn bộ bảng (gộp với lần làm mới đang chạy nếu có)"""
+        return self._flight.do("all", lambda: self._refresh_all(priority))
+
+    def recently_used(self, window=_PRICE_DEMAND_WINDOW):
+        return time.time() - self.last_access < window
+
+    def _refresh_one(self, symbol, priority=None):
+        data = binance_api_request(f"{self.url}?symbol={symbol}", priority=priority)
+        if data and self.price_field in data:
+            price = float(data[self.price_field])
+            self._prices.set(symbol, price)
+            return price
+        return 0
+
+    def get(self, symbol, priority=None):
+        """
+        Giá của symbol. priority (PRIORITY_*) cho request REST khi phải tải:
+        mặc định theo endpoint (ưu tiên quét), bot đang giữ vị thế truyền mức cao hơn
+        """
+        symbol = symbol.upper()
+        self.last_access = time.time()
+        price = self._lookup(symbol)
+        if price is not None:
+            return price
+
+        # Bảng vừa làm mới mà vẫn thiếu symbol -> chỉ hỏi riêng symbol đó
+        if time.time() - self._last_refresh < self.ttl:
+            return self._refresh_one(symbol, priority)
+
+        self.refresh(priority)
+        price = self._lookup(symbol)
+        if price is not None:
+            return price
+        # Lần làm mới (có thể ưu tiên thấp, bị bỏ do quá tải) không có giá: hỏi riêng
+        return self._refresh_one(symbol, priority)
+
+    def update(self, symbol, price):
+        """Ghi giá từ nguồn khác (vd. websocket) để các bot dùng chung"""
+        self._prices.set(symbol.upper(), price)
+
+
+_PRICE_TABLE = PriceTable("price", "https://fapi.binance.com/fapi/v1/ticker/price", "price")
+_MARK_PRICE_TABLE = PriceTable("mark_price", "https://fapi.binance.com/fapi/v1/premiumIndex", "markPrice")
+
+
+def get_price_with_cache(symbol, priority=None):
+    """Lấy giá với cache để giảm API call"""
+    try:
+        return _PRICE_TABLE.get(symbol, priority)
+    except Exception as e:
+        logger.error(f"Lỗi giá {symbol}: {str(e)}")
+        return 0
+
+
+def get_mark_price_with_cache(symbol, priority=None):
+    """Lấy mark price với cache (làm mới hàng loạt qua /premiumIndex)"""
+    try:
+        return _MARK_PRICE_TABLE.get(symbol, priority)
+    except Exception as e:
+        logger.error(f"Lỗi mark price {symbol}: {str(e)}")
+        return 0
+
+
+class SymbolRegistry:
+    """
+    Bảng metadata symbol dựng MỘT LẦN cho mỗi lần làm mới exchangeInfo.
+    Tra cứu O(1) theo symbol; bảng mới được thay nguyên khối nên luồng đọc
+    không bao giờ thấy bảng đang dựng dở.
+    """
+
+    def __init__(self):
+        self._symbols = {}
+        self._source_id = None
+        self._lock = threading.Lock()
+        self.built_at = 0
+
+    @staticmethod
+    def _parse_symbol(symbol_info):
+        filters = {f.get("filterType"): f for f in symbol_info.get("filters", [])}
+        lot_size = filters.get("LOT_SIZE", {})
+        market_lot_size = filters.get("MARKET_LOT_SIZE", {})
+        price_filter = filters.get("PRICE_FILTER", {})
+        min_notional = filters.get("MIN_NOTIONAL", {})
+        leverage_filter = filters.get("LEVERAGE", {})
+
+        return {
+            "symbol": symbol_info.get("symbol", ""),
+            "status": symbol_info.get("status", ""),
+            "contract_type": symbol_info.get("contractType", ""),
+            "quote_asset": symbol_info.get("quoteAsset", ""),
+            "step_size": float(lot_size.get("stepSize", 0.001)),
+            "min_qty": float(lot_size.get("minQty", 0)),
+            "max_qty": float(lot_size.get("maxQty", 0)),
+            "market_step_size": float(market_lot_size.get("stepSize", lot_size.get("stepSize", 0.001))),
+            "market_min_qty": float(market_lot_size.get("minQty", 0)),
+            "market_max_qty": float(market_lot_size.get("maxQty", 0)),
+            "tick_size": float(price_filter.get("tickSize", 0)),
+            "min_notional": float(min_notional.get("notional", min_notional.get("minNotional", 0))),
+            "max_leverage": (
+                int(leverage_filter["maxLeverage"]) if "maxLeverage" in leverage_filter else None
+            ),
+        }
+
+    def rebuild(self, exchange_info):
+        """Dựng lại bảng từ exchangeInfo (bỏ qua nếu đã dựng từ đúng tài liệu này)"""
+        if not exchange_info:
+            return
+        with self._lock:
+            if self._source_id == id(exchange_info):
+                return
+            symbols = {}
+            for symbol_info in exchange_info.get("symbols", []):
+                try:
+                    info = self._parse_symbol(symbol_info)
+                except (TypeError, ValueError) as e:
+                    logger.error(f"Lỗi đọc metadata {symbol_info.get('symbol')}: {str(e)}")
+                    continue
+                symbols[info["symbol"]] = info
+            self._symbols = symbols
+            self._source_id = id(exchange_info)
+            self.built_at = time.time()
+        logger.info(f"✅ Đã dựng bảng metadata cho {len(symbols)} symbol")
+
+    def get(self, symbol):
+        if not symbol:
+            return None
+        return self._symbols.get(symbol.upper())
+
+    def symbols(self):
+        return list(self._symbols.values())
+
+    def __len__(self):
+        return len(self._symbols)
+
+
+_SYMBOL_REGISTRY = SymbolRegistry()
+
+
+_EXCHANGE_INFO_CACHE = TTLCache(
+    "exchange_info", _EXCHANGE_INFO_CACHE_TTL, max_size=1, stale_ttl=_EXCHANGE_INFO_CACHE_STALE
+)
+# exchangeInfo tốt gần nhất: dùng lại khi tải lỗi; retry_at chặn tải lại liên tục khi sàn lỗi
+_EXCHANGE_INFO_LAST_GOOD = {"data": None, "retry_at": 0}
+
+
+def _load_exchange_info():
+    url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
+    data = binance_api_request(url)
+    if data:
+        _SYMBOL_REGISTRY.rebuild(data)
+        _EXCHANGE_INFO_LAST_GOOD["data"] = data
+        return data
+    return None
+
+
+def get_exchange_info():
+    """
+    Lấy và cache exchangeInfo, dựng lại bảng metadata symbol khi làm mới.
+    Tải lỗi thì dùng lại dữ liệu tốt gần nhất (registry vẫn giữ bản đó).
+    """
+    snapshot = _MARKET_DATA.get(
+        "exchange_info", max_age=_EXCHANGE_INFO_CACHE_TTL + _EXCHANGE_INFO_CACHE_STALE
+    )
+    if snapshot is not None:
+        return snapshot
+    data = None
+    if time.time() >= _EXCHANGE_INFO_LAST_GOOD["retry_at"]:
+        try:
+            data = _EXCHANGE_INFO_CACHE.get_or_load("all", _load_exchange_info)
+        except Exception as e:
+            logger.error(f"Lỗi lấy exchangeInfo: {str(e)}")
+        if data is None:
+            _EXCHANGE_INFO_LAST_GOOD["retry_at"] = time.time() + _MARKET_REFRESH_RETRY
+    if data is None:
+        data = _EXCHANGE_INFO_LAST_GOOD["data"] or _MARKET_DATA.get("exchange_info")
+    return data
+
+
+def get_symbol_registry():
+    """Bảng metadata symbol, đảm bảo exchangeInfo còn hạn"""
+    get_exchange_info()
+    return _SYMBOL_REGISTRY
+
+
+def get_symbol_info(symbol):
+    """Metadata của một symbol (step/tick size, min qty, min notional...) hoặc None"""
+    return get_symbol_registry().get(symbol)
+
+
+class WarmStartStore:
+    """
+    Lưu metadata thị trường xuống SQLite (JSON nén zlib, mỗi key một dòng) để
+    lần khởi động sau dùng ngay thay vì tải lại tất cả cùng lúc.
+    Mọi lỗi đĩa chỉ ghi log: cache trên đĩa là tùy chọn, không được làm hỏng bot.
+    """
+
+    def __init__(self, path=_WARM_CACHE_PATH, save_interval=_WARM_CACHE_SAVE_INTERVAL):
+        self.path = path
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._last_saved = {}
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._initialized:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS market_cache ("
+                "key TEXT PRIMARY KEY, fetched_at REAL NOT NULL, payload BLOB NOT NULL)"
+            )
+            self._initialized = True
+        return conn
+
+    def load(self, key, max_age=_WARM_CACHE_MAX_AGE):
+        """Trả về (dữ liệu, thời điểm tải) hoặc None nếu không có/quá cũ/lỗi"""
+        if not self.path:
+            return None
+        try:
+            with self._lock:
+                conn = self._connect()
+                try:
+                    row = conn.execute(
+                        "SELECT fetched_at, payload FROM market_cache WHERE key = ?", (key,)
+                    ).fetchone()
+                finally:
+                    conn.close()
+            if row is None:
+                return None
+            fetched_at, payload = row
+            if time.time() - fetched_at > max_age:
+                return None
+            return json_loads(zlib.decompress(payload)), fetched_at
+        except Exception as e:
+            logger.warning(f"⚠️ Không đọc được cache trên đĩa {key}: {str(e)}")
+            return None
+
+    def save(self, key, data, fetched_at=None, force=False):
+        if not self.path:
+            return False
+        fetched_at = fetched_at or time.time()
+        if not force and fetched_at - self._last_saved.get(key, 0) < self.save_interval:
+            return False
+        try:
+            payload = zlib.compress(
+                json.dumps(data, separators=(",", ":"), default=dict).encode("utf-8")
+            )
+            with self._lock:
+                conn = self._connect()
+                try:
+                    with conn:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO market_cache (key, fetched_at, payload) "
+                            "VALUES (?, ?, ?)",
+                            (key, fetched_at, payload),
+                        )
+                finally:
+                    conn.close()
+                self._last_saved[key] = fetched_at
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ Không ghi được cache xuống đĩa {key}: {str(e)}")
+            return False
+
 
+_WARM_STORE = WarmStartStore()
 
-def get_price_with_cache(symbol):
-    """Lấy giá với cache để giảm API call"""
-    global _PRICE_CACHE
-    try:
-        symbol = symbol.upper()
-        now = time.time()
-        
-        if (symbol in _PRICE_CACHE["dữ_liệu"] and 
-            now - _PRICE_CACHE["cập_nhật_cuối"] < _PRICE_CACHE_TTL):
-            return _PRICE_CACHE["dữ_liệu"][symbol]
-        
-        url = f"https://fapi.binance.com/fapi/v1/ticker/price?symbol={symbol}"
-        data = binance_api_request(url)
-        if data and "price" in data:
-            price = float(data["price"])
-            _PRICE_CACHE["dữ_liệu"][symbol] = price
-            _PRICE_CACHE["cập_nhật_cuối"] = now
-            return price
-        return 0
-    except Exception as e:
-        logger.error(f"Lỗi giá {symbol}: {str(e)}")
-        return 0
 
+class MarketDataRefresher:
+    """
+    Luồng nền làm mới dữ liệu thị trường dùng chung (24h ticker, exchangeInfo, bảng giá)
+    TRƯỚC khi hết hạn và công bố ảnh chụp bất biến. Luồng bot chỉ đọc ảnh chụp
+    trong bộ nhớ, không phải tự tải lại giữa vòng giao dịch.
+    """
 
-def get_exchange_info():
-    """Lấy và cache exchangeInfo"""
-    global _EXCHANGE_INFO_CACHE
-    try:
-        current_time = time.time()
-        
-        if (_EXCHANGE_INFO_CACHE["dữ_liệu"] is not None and 
-            current_time - _EXCHANGE_INFO_CACHE["cập_nhật_cuối"] < _EXCHANGE_INFO_CACHE_TTL):
-            return _EXCHANGE_INFO_CACHE["dữ_liệu"]
-        
-        url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
-        data = binance_api_request(url)
-        
-        if data:
-            _EXCHANGE_INFO_CACHE["dữ_liệu"] = data
-            _EXCHANGE_INFO_CACHE["cập_nhật_cuối"] = current_time
-        
-        return data
-    except Exception as e:
-        logger.error(f"Lỗi lấy exchangeInfo: {str(e)}")
+    def __init__(self, lead=_MARKET_REFRESH_LEAD, retry_delay=_MARKET_REFRESH_RETRY, store=None):
+        self.lead = lead
+        self.retry_delay = retry_delay
+        self.store = store
+        self._tasks = {}
+        self._snapshots = {}
+        self._warm = frozenset()  # Ảnh chụp nạp từ đĩa, chưa được làm mới lần nào
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def register(self, name, loader, ttl, enabled=None, restore=None):
+        """
+        loader() trả về dữ liệu (None nếu lỗi); enabled() (tùy chọn) cho biết
+        có cần làm mới lúc này không; restore(dữ liệu JSON) (tùy chọn) bật lưu
+        xuống đĩa và dựng lại dữ liệu khi khởi động
+        """
+        with self._lock:
+            self._tasks[name] = {
+                "loader": loader,
+                "interval": ttl * self.lead,
+                "enabled": enabled,
+                "restore": restore,
+                "next_run": 0,
+            }
+
+    def publish(self, name, data, fetched_at=None, warm=False):
+        snapshot = MarketSnapshot(data, fetched_at or time.time())
+        with self._lock:
+            # Copy-on-write: luồng đọc luôn thấy dict cũ hoặc mới trọn vẹn
+            snapshots = dict(self._snapshots)
+            snapshots[name] = snapshot
+            self._snapshots = snapshots
+            self._warm = self._warm | {name} if warm else self._warm - {name}
+            task = self._tasks.get(name)
+        if not warm and self.store and task and task["restore"]:
+            self.store.save(name, data, snapshot.fetched_at)
+
+    def get(self, name, max_age=None):
+        """Dữ liệu ảnh chụp mới nhất (không khóa), None nếu chưa có hoặc quá cũ"""
+        snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            return None
+        if name in self._warm:
+            # Dữ liệu từ lần chạy trước: tạm dùng cho tới khi làm mới xong
+            max_age = max(max_age or 0, _WARM_CACHE_MAX_AGE)
+        if max_age is not None and time.time() - snapshot.fetched_at > max_age:
+            return None
+        return snapshot.data
+
+    def _warm_start(self):
+        """Nạp ảnh chụp đã lưu trên đĩa; task được lên lịch làm mới theo tuổi dữ liệu"""
+        if not self.store:
+            return
+        with self._lock:
+            tasks = list(self._tasks.items())
+        for name, task in tasks:
+            if not task["restore"]:
+                continue
+            stored = self.store.load(name)
+            if stored is None:
+                continue
+            data, fetched_at = stored
+            try:
+                data = task["restore"](data)
+            except Exception as e:
+                logger.warning(f"⚠️ Bỏ qua cache trên đĩa {name}: {str(e)}")
+                continue
+            self.publish(name, data, fetched_at=fetched_at, warm=True)
+            task["next_run"] = fetched_at + task["interval"]
+            logger.info(f"♻️ Nạp {name} từ đĩa (tuổi {time.time() - fetched_at:.0f}s)")
+
+    def _run_task(self, name, task):
+        enabled = task["enabled"]
+        if enabled is not None and not enabled():
+            task["next_run"] = time.time() + task["interval"]
+            return
+        try:
+            data = task["loader"]()
+        except Exception as e:
+            logger.error(f"Lỗi làm mới dữ liệu thị trường {name}: {str(e)}")
+            data = None
+        if data is None:
+            task["next_run"] = time.time() + self.retry_delay
+            return
+        self.publish(name, data)
+        task["next_run"] = time.time() + task["interval"]
+
+    def _run_with_warm_start(self):
+        self._warm_start()
+        self._run()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self._lock:
+                tasks = list(self._tasks.items())
+            now = time.time()
+            for name, task in tasks:
+                if task["next_run"] <= now:
+                    self._run_task(name, task)
+                    if self._stop_event.is_set():
+                        return
+            with self._lock:
+                next_run = min((t["next_run"] for t in self._tasks.values()), default=now + 1)
+            self._stop_event.wait(max(0.1, next_run - time.time()))
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run_with_warm_start, daemon=True)
+            self._thread.start()
+        logger.info("✅ Đã khởi động luồng làm mới dữ liệu thị trường")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def _freeze_ticker_24h_rows(data):
+    return tuple(MappingProxyType(dict(item)) for item in data)
+
+
+def _freeze_ticker_24h():
+    data = _load_ticker_24h_data()
+    if data is None:
         return None
+    return _freeze_ticker_24h_rows(data)
 
 
-def get_max_leverage(symbol, api_key, api_secret):
-    global _LEVERAGE_CACHE
-    try:
-        symbol = symbol.upper()
-        current_time = time.time()
+def _restore_exchange_info(data):
+    _SYMBOL_REGISTRY.rebuild(data)
+    _EXCHANGE_INFO_LAST_GOOD["data"] = data
+    return data
 
-        if (
-            symbol in _LEVERAGE_CACHE["dữ_liệu"]
-            and current_time - _LEVERAGE_CACHE["cập_nhật_cuối"] < _LEVERAGE_CACHE_TTL
-        ):
-            return _LEVERAGE_CACHE["dữ_liệu"][symbol]
 
-        exchange_info = get_exchange_info()
-        if not exchange_info:
-            return 100
+_MARKET_DATA = MarketDataRefresher(store=_WARM_STORE)
+_MARKET_DATA.register(
+    "ticker_24h", _freeze_ticker_24h, _VOLUME_CACHE_TTL, restore=_freeze_ticker_24h_rows
+)
+_MARKET_DATA.register(
+    "exchange_info", _load_exchange_info, _EXCHANGE_INFO_CACHE_TTL, restore=_restore_exchange_info
+)
+_MARKET_DATA.register(
+    "prices", _PRICE_TABLE.refresh, _PRICE_CACHE_TTL, enabled=_PRICE_TABLE.recently_used
+)
+
+
+class LeverageBracketTable:
+    """
+    Bracket đòn bẩy theo symbol từ /fapi/v1/leverageBracket: mỗi khoảng notional
+    có đòn bẩy tối đa và tỉ lệ ký quỹ duy trì riêng. Dựng một lần mỗi lần tải,
+    thay nguyên khối giống SymbolRegistry.
+    """
+
+    def __init__(self):
+        self._brackets = {}  # symbol -> tuple((floor, cap, max_lev, mmr, cum), ...)
+        self._source_id = None
+        self._lock = threading.Lock()
+
+    def rebuild(self, data):
+        if not data:
+            return
+        with self._lock:
+            if self._source_id == id(data):
+                return
+            brackets = {}
+            for item in data:
+                try:
+                    rows = sorted(
+                        (
+                            float(b.get("notionalFloor", 0)),
+                            float(b.get("notionalCap", 0)),
+                            int(b.get("initialLeverage", 1)),
+                            float(b.get("maintMarginRatio", 0)),
+                            float(b.get("cum", 0)),
+                        )
+                        for b in item.get("brackets", [])
+                    )
+                except (TypeError, ValueError) as e:
+                    logger.error(f"Lỗi đọc bracket {item.get('symbol')}: {str(e)}")
+                    continue
+                if rows:
+                    brackets[item.get("symbol")] = tuple(rows)
+            self._brackets = brackets
+            self._source_id = id(data)
+        logger.info(f"✅ Đã dựng bảng bracket đòn bẩy cho {len(brackets)} symbol")
+
+    def _find(self, symbol, notional):
+        rows = self._brackets.get(symbol.upper()) if symbol else None
+        if not rows:
+            return None
+        for row in rows:
+            if notional < row[1]:
+                return row
+        return rows[-1]
+
+    def has_data(self):
+        return bool(self._brackets)
+
+    def max_leverage(self, symbol, notional=0):
+        """Đòn bẩy tối đa cho vị thế có notional cho trước, None nếu chưa biết symbol"""
+        row = self._find(symbol, notional)
+        return row[2] if row else None
+
+    def maintenance_margin(self, symbol, notional):
+        """(tỉ lệ ký quỹ duy trì, cum) cho notional, None nếu chưa biết symbol"""
+        row = self._find(symbol, notional)
+        return (row[3], row[4]) if row else None
+
+    def leverage_for_margin(self, symbol, margin, desired_leverage):
+        """Đòn bẩy lớn nhất <= desired mà notional = margin * đòn bẩy vẫn nằm trong giới hạn"""
+        if symbol.upper() not in self._brackets:
+            return None
+        for leverage in range(int(desired_leverage), 0, -1):
+            if self.max_leverage(symbol, margin * leverage) >= leverage:
+                return leverage
+        return None
+
+
+_LEVERAGE_BRACKETS = LeverageBracketTable()
+_LEVERAGE_BRACKET_CACHE = TTLCache(
+    "leverage_brackets", _LEVERAGE_BRACKET_TTL, max_size=1, stale_ttl=_LEVERAGE_BRACKET_STALE
+)
+# Endpoint có ký: cần key của tài khoản (bracket có thể khác nhau giữa các tài khoản)
+_LEVERAGE_BRACKET_CREDENTIALS = {}
+# Lần tải lỗi gần nhất: không gửi lại trước retry_at (tránh dồn request khi sàn lỗi)
+_LEVERAGE_BRACKET_FAILURE = {"retry_at": 0, "backoff": 0}
+
+
+def configure_leverage_brackets(api_key, api_secret):
+    if api_key and api_secret:
+        _LEVERAGE_BRACKET_CREDENTIALS.update(api_key=api_key, api_secret=api_secret)
 
-        for s in exchange_info["symbols"]:
-            if s["symbol"] == symbol:
-                for f in s["filters"]:
-                    if f["filterType"] == "LEVERAGE" and "maxLeverage" in f:
-                        leverage = int(f["maxLeverage"])
-                        _LEVERAGE_CACHE["dữ_liệu"][symbol] = leverage
-                        _LEVERAGE_CACHE["cập_nhật_cuối"] = current_time
-                        return leverage
-        return 100
+
+def _load_leverage_brackets():
+    api_key = _LEVERAGE_BRACKET_CREDENTIALS.get("api_key")
+    api_secret = _LEVERAGE_BRACKET_CREDENTIALS.get("api_secret")
+    if not api_key or not api_secret:
+        return None
+    ts = get_synchronized_timestamp()
+    query = urllib.parse.urlencode({"timestamp": ts, "recvWindow": 10000})
+    sig = sign(query, api_secret)
+    url = f"https://fapi.binance.com/fapi/v1/leverageBracket?{query}&signature={sig}"
+    data = binance_api_request(url, headers={"X-MBX-APIKEY": api_key})
+    if not isinstance(data, list):
+        return None
+    _LEVERAGE_BRACKETS.rebuild(data)
+    return data
+
+
+def _restore_leverage_brackets(data):
+    _LEVERAGE_BRACKETS.rebuild(data)
+    return data
+
+
+_MARKET_DATA.register(
+    "leverage_brackets",
+    _load_leverage_brackets,
+    _LEVERAGE_BRACKET_TTL,
+    enabled=lambda: bool(_LEVERAGE_BRACKET_CREDENTIALS),
+    restore=_restore_leverage_brackets,
+)
+
+
+def get_leverage_brackets(api_key=None, api_secret=None):
+    """Bảng bracket đòn bẩy, tải (có ký) nếu chưa có hoặc đã hết hạn"""
+    configure_leverage_brackets(api_key, api_secret)
+    snapshot = _MARKET_DATA.get(
+        "leverage_brackets", max_age=_LEVERAGE_BRACKET_TTL + _LEVERAGE_BRACKET_STALE
+    )
+    if (
+        snapshot is None
+        and _LEVERAGE_BRACKET_CREDENTIALS
+        and time.time() >= _LEVERAGE_BRACKET_FAILURE["retry_at"]
+    ):
+        try:
+            data = _LEVERAGE_BRACKET_CACHE.get_or_load("all", _load_leverage_brackets)
+        except Exception as e:
+            logger.error(f"Lỗi lấy bracket đòn bẩy: {str(e)}")
+            data = None
+        if data is None:
+            # Trong lúc chờ: dùng bảng cũ (nếu có), rồi registry / đòn bẩy mặc định
+            backoff = min(
+                max(_LEVERAGE_BRACKET_FAILURE["backoff"] * 2, _LEVERAGE_BRACKET_FAILURE_BACKOFF),
+                _LEVERAGE_BRACKET_FAILURE_MAX_BACKOFF,
+            )
+            _LEVERAGE_BRACKET_FAILURE.update(retry_at=time.time() + backoff, backoff=backoff)
+            logger.warning(f"⚠️ Không tải được bracket đòn bẩy, thử lại sau {backoff}s")
+        else:
+            _LEVERAGE_BRACKET_FAILURE.update(retry_at=0, backoff=0)
+    return _LEVERAGE_BRACKETS
+
+
+def start_market_data_refresher():
+    _MARKET_DATA.start()
+
+
+def get_max_leverage(symbol, api_key, api_secret, notional=0):
+    """Đòn bẩy tối đa của symbol cho vị thế có giá trị notional (USDT)"""
+    try:
+        max_leverage = get_leverage_brackets(api_key, api_secret).max_leverage(symbol, notional)
+        if max_leverage:
+            return max_leverage
+        info = get_symbol_info(symbol)
+        if info and info["max_leverage"]:
+            return info["max_leverage"]
+        return _LEVERAGE_FALLBACK
     except Exception as e:
         logger.error(f"Lỗi đòn bẩy {symbol}: {str(e)}")
-        return 100
+        return _LEVERAGE_FALLBACK
+
+
+def get_maintenance_margin_rate(symbol, notional, api_key=None, api_secret=None):
+    """(tỉ lệ ký quỹ duy trì, cum) theo bracket của notional, None nếu chưa có dữ liệu"""
+    try:
+        return get_leverage_brackets(api_key, api_secret).maintenance_margin(symbol, notional)
+    except Exception as e:
+        logger.error(f"Lỗi tỉ lệ ký quỹ duy trì {symbol}: {str(e)}")
+        return None
 
 
 def get_step_size(symbol, api_key, api_secret):
-    global _STEP_SIZE_CACHE
     if not symbol:
         return 0.001
-    
-    symbol = symbol.upper()
-    current_time = time.time()
-    
-    if (symbol in _STEP_SIZE_CACHE["dữ_liệu"] and 
-        current_time - _STEP_SIZE_CACHE["cập_nhật_cuối"] < _STEP_SIZE_CACHE_TTL):
-        return _STEP_SIZE_CACHE["dữ_liệu"][symbol]
-    
+
     try:
-        exchange_info = get_exchange_info()
-        if not exchange_info:
-            return 0.001
-            
-        for s in exchange_info["symbols"]:
-            if s["symbol"] == symbol:
-                for f in s["filters"]:
-                    if f["filterType"] == "LOT_SIZE":
-                        step_size = float(f["stepSize"])
-                        _STEP_SIZE_CACHE["dữ_liệu"][symbol] = step_size
-                        _STEP_SIZE_CACHE["cập_nhật_cuối"] = current_time
-                        return step_size
+        info = get_symbol_info(symbol)
+        if info:
+            return info["step_size"]
     except Exception as e:
         logger.error(f"Lỗi step size: {str(e)}")
-    
+
     return 0.001
 
 
+class AppliedLeverageCache:
+    """
+    Đòn bẩy ĐANG áp dụng trên sàn theo (api key, symbol): nạp từ trường `leverage`
+    của positionRisk và cập nhật sau mỗi lần set_leverage thành công, để bỏ qua
+    lời gọi set_leverage khi đòn bẩy không đổi.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key, symbol):
+        return self._data.get((api_key, symbol.upper()))
+
+    def set(self, api_key, symbol, leverage):
+        with self._lock:
+            self._data[(api_key, symbol.upper())] = int(leverage)
+
+    def invalidate(self, api_key, symbol):
+        with self._lock:
+            self._data.pop((api_key, symbol.upper()), None)
+
+    def update_from_positions(self, api_key, positions):
+        updates = {}
+        for pos in positions or []:
+            try:
+                updates[(api_key, pos["symbol"])] = int(float(pos["leverage"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+        if updates:
+            with self._lock:
+                self._data.update(updates)
+
+
+_APPLIED_LEVERAGE = AppliedLeverageCache()
+_LEVERAGE_PREWARM_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+def get_applied_leverage(symbol, api_key):
+    """Đòn bẩy đang áp dụng trên sàn (theo dữ liệu đã biết), None nếu chưa biết"""
+    return _APPLIED_LEVERAGE.get(api_key, symbol)
+
+
+def seed_applied_leverage(api_key, api_secret):
+    """Nạp đòn bẩy đang áp dụng của mọi symbol từ một lần gọi positionRisk"""
+    positions = get_positions(api_key=api_key, api_secret=api_secret)
+    if positions:
+        logger.info(f"✅ Đã nạp đòn bẩy hiện tại của {len(positions)} symbol")
+    return bool(positions)
+
+
+def prewarm_leverage(symbols, leverage, api_key, api_secret, top_n=_LEVERAGE_PREWARM_TOP_N):
+    """Đặt sẵn đòn bẩy ở luồng nền cho các coin ứng viên trước khi bot vào lệnh"""
+    if top_n <= 0:
+        return
+    for symbol in symbols[:top_n]:
+        if _APPLIED_LEVERAGE.get(api_key, symbol) != leverage:
+            _LEVERAGE_PREWARM_EXECUTOR.submit(set_leverage, symbol, leverage, api_key, api_secret)
+
+
 def set_leverage(symbol, lev, api_key, api_secret):
     if not symbol:
         logger.error("❌ set_leverage: Symbol không hợp lệ")
@@ -753,6 +2649,10 @@ def set_leverage(symbol, lev, api_key, api_secret):
         
         if adjusted_lev != lev:
             logger.warning(f"⚠️ {symbol}: Leverage đã điều chỉnh từ {lev}x → {adjusted_lev}x")
+
+        # Sàn đã áp dụng đúng đòn bẩy này: không cần gọi lại
+        if _APPLIED_LEVERAGE.get(api_key, symbol) == adjusted_lev:
+            return True
         
         ts = get_synchronized_timestamp()
         params = {
@@ -775,11 +2675,15 @@ def set_leverage(symbol, lev, api_key, api_secret):
             
         if "leverage" in response:
             actual_leverage = response.get("leverage", adjusted_lev)
+            _APPLIED_LEVERAGE.set(api_key, symbol, actual_leverage)
             logger.info(f"✅ set_leverage {symbol}: Đặt đòn bẩy {actual_leverage}x thành công")
             return True
         else:
+            _APPLIED_LEVERAGE.invalidate(api_key, symbol)
             # Thử log chi tiết lỗi nếu có
             error_msg = response.get("msg", "Không rõ lý do")
+            if _is_symbol_level_error(response):
+                _NEGATIVE_CACHE.record_failure(symbol, FAILURE_LEVERAGE, error_msg)
             logger.error(f"❌ set_leverage {symbol}: API trả về lỗi: {error_msg}")
             logger.error(f"❌ Phản hồi đầy đủ: {response}")
             return False
@@ -790,8 +2694,67 @@ def set_leverage(symbol, lev, api_key, api_secret):
         return False
 
 
-def get_balance(api_key, api_secret):
-    try:
+AccountSnapshot = namedtuple(
+    "AccountSnapshot",
+    ["assets", "total_margin_balance", "total_maint_margin", "positions", "fetched_at"],
+)
+
+
+class AccountState:
+    """
+    Một ảnh chụp /fapi/v2/account cho mỗi api key, dùng chung cho get_balance,
+    get_total_and_available_balance và get_margin_safety_info.
+    - assets: asset -> (walletBalance, availableBalance)
+    - positions: symbol -> vị thế đang mở (đã rút gọn)
+    Đọc trong bộ nhớ nếu ảnh chụp chưa quá max_age; invalidate() sau khi khớp lệnh.
+    invalidate() tăng generation: lần tải bắt đầu trước đó không được lưu kết quả.
+    """
+
+    def __init__(self, max_age=_ACCOUNT_STATE_MAX_AGE):
+        self.max_age = max_age
+        self._max_age_overrides = {}
+        self._snapshots = {}
+        self._generations = {}  # api_key -> generation
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.fetch_count = 0
+        self.discarded_count = 0
+
+    def set_max_age(self, api_key, max_age=None):
+        """Đổi tuổi tối đa cho một api key (None = mặc định), vd. khi có user data stream"""
+        with self._lock:
+            if max_age is None:
+                self._max_age_overrides.pop(api_key, None)
+            else:
+                self._max_age_overrides[api_key] = max_age
+
+    @staticmethod
+    def _parse(data):
+        assets = {}
+        for asset in data.get("assets", []):
+            assets[asset["asset"]] = (
+                float(asset.get("walletBalance", 0)),
+                float(asset.get("availableBalance", 0)),
+            )
+        positions = {}
+        for pos in data.get("positions", []):
+            position_amt = float(pos.get("positionAmt", 0))
+            if position_amt != 0:
+                positions[pos["symbol"]] = MappingProxyType({
+                    "positionAmt": position_amt,
+                    "entryPrice": float(pos.get("entryPrice", 0)),
+                    "unrealizedProfit": float(pos.get("unrealizedProfit", 0)),
+                    "leverage": int(float(pos.get("leverage", 0))),
+                })
+        return AccountSnapshot(
+            MappingProxyType(assets),
+            float(data.get("totalMarginBalance", 0.0)),
+            float(data.get("totalMaintMargin", 0.0)),
+            MappingProxyType(positions),
+            time.time(),
+        )
+
+    def _fetch(self, api_key, api_secret, generation):
         ts = get_synchronized_timestamp()
         params = {"timestamp": ts, "recvWindow": 10000}
         query = urllib.parse.urlencode(params)
@@ -799,29 +2762,81 @@ def get_balance(api_key, api_secret):
         url = f"https://fapi.binance.com/fapi/v2/account?{query}&signature={sig}"
         headers = {"X-MBX-APIKEY": api_key}
 
-        data = binance_api_request(url, headers=headers)
+        # Không gộp với request đang chạy: nó có thể bắt đầu trước invalidate()
+        data = binance_api_request(
+            url, headers=headers, priority=PRIORITY_ACCOUNT, coalesce=False
+        )
         if not data:
+            return None
+        snapshot = self._parse(data)
+        _APPLIED_LEVERAGE.update_from_positions(api_key, data.get("positions"))
+        with self._lock:
+            self.fetch_count += 1
+            if generation != self._generations.get(api_key, 0):
+                # Đã invalidate trong lúc tải: chỉ trả cho các luồng đang chờ
+                self.discarded_count += 1
+                return snapshot
+            self._snapshots[api_key] = snapshot
+        return snapshot
+
+    def get(self, api_key, api_secret, max_age=None, force=False):
+        """Ảnh chụp tài khoản còn đủ mới, tải lại (gộp các luồng) nếu cần; None nếu lỗi"""
+        if max_age is None:
+            max_age = self._max_age_overrides.get(api_key, self.max_age)
+        snapshot = self._snapshots.get(api_key)
+        if not force and snapshot is not None and time.time() - snapshot.fetched_at <= max_age:
+            return snapshot
+        # Chỉ gộp với lần tải cùng generation: sau invalidate luôn tải mới
+        generation = self._generations.get(api_key, 0)
+        return self._flight.do(
+            (api_key, generation), lambda: self._fetch(api_key, api_secret, generation)
+        )
+
+    def publish(self, api_key, snapshot):
+        """Thay ảnh chụp từ nguồn khác (vd. user data stream)"""
+        with self._lock:
+            self._generations[api_key] = self._generations.get(api_key, 0) + 1
+            self._snapshots[api_key] = snapshot
+
+    def invalidate(self, api_key):
+        """Buộc lần đọc kế tiếp tải lại (sau khi khớp lệnh, số dư đã đổi)"""
+        with self._lock:
+            self._generations[api_key] = self._generations.get(api_key, 0) + 1
+            self._snapshots.pop(api_key, None)
+
+
+_ACCOUNT_STATE = AccountState()
+
+
+def get_account_state(api_key, api_secret, max_age=None, force=False):
+    return _ACCOUNT_STATE.get(api_key, api_secret, max_age=max_age, force=force)
+
+
+def invalidate_account_state(api_key):
+    _ACCOUNT_STATE.invalidate(api_key)
+
+
+def get_balance(api_key, api_secret):
+    try:
+        account = get_account_state(api_key, api_secret)
+        if not account:
             logger.error("❌ get_balance: Không lấy được dữ liệu từ API")
             return None
 
         # Tính tổng số dư USDT và USDC (nếu có) để đảm bảo không nhầm thành 0
         total_balance = 0.0
-        for asset in data["assets"]:
-            if asset["asset"] in ["USDT", "USDC"]:
-                available_balance = float(asset["availableBalance"])
-                wallet_balance = float(asset["walletBalance"])
+        for asset in ["USDT", "USDC"]:
+            if asset in account.assets:
+                wallet_balance, available_balance = account.assets[asset]
                 # Ưu tiên sử dụng availableBalance, nhưng nếu = 0 thì dùng walletBalance
                 if available_balance > 0:
                     total_balance += available_balance
                 else:
                     total_balance += wallet_balance
 
-        if total_balance <= 0:
+        if total_balance <= 0 and "USDT" in account.assets:
             # Nếu vẫn = 0, kiểm tra lại với availableBalance
-            for asset in data["assets"]:
-                if asset["asset"] == "USDT":
-                    total_balance = float(asset["availableBalance"])
-                    break
+            total_balance = account.assets["USDT"][1]
         
         logger.info(f"💰 Số dư - Khả dụng: {total_balance:.2f} USDT")
         return total_balance
@@ -835,15 +2850,8 @@ def get_total_and_available_balance(api_key, api_secret):
     Lấy TỔNG số dư (USDT + USDC) và số dư KHẢ DỤNG tương ứng.
     """
     try:
-        ts = get_synchronized_timestamp()
-        params = {"timestamp": ts, "recvWindow": 10000}
-        query = urllib.parse.urlencode(params)
-        sig = sign(query, api_secret)
-        url = f"https://fapi.binance.com/fapi/v2/account?{query}&signature={sig}"
-        headers = {"X-MBX-APIKEY": api_key}
-
-        data = binance_api_request(url, headers=headers)
-        if not data:
+        account = get_account_state(api_key, api_secret)
+        if not account:
             logger.error("❌ Không lấy được số dư từ Binance")
             return None, None
 
@@ -851,18 +2859,15 @@ def get_total_and_available_balance(api_key, api_secret):
         available_all = 0.0
 
         # Tính tổng cả USDT và USDC để đảm bảo không bị 0
-        for asset in data["assets"]:
-            if asset["asset"] in ["USDT", "USDC"]:
-                available_all += float(asset["availableBalance"])
-                total_all += float(asset["walletBalance"])
+        for asset in ["USDT", "USDC"]:
+            if asset in account.assets:
+                wallet_balance, available_balance = account.assets[asset]
+                available_all += available_balance
+                total_all += wallet_balance
 
         # Nếu tổng = 0, thử lấy USDT riêng
-        if total_all <= 0:
-            for asset in data["assets"]:
-                if asset["asset"] == "USDT":
-                    total_all = float(asset["walletBalance"])
-                    available_all = float(asset["availableBalance"])
-                    break
+        if total_all <= 0 and "USDT" in account.assets:
+            total_all, available_all = account.assets["USDT"]
 
         logger.info(
             f"💰 Tổng số dư: {total_all:.2f}, "
@@ -883,20 +2888,13 @@ def get_margin_safety_info(api_key, api_secret):
     """
     global _LAST_MARGIN_LOG_TIME
     try:
-        ts = get_synchronized_timestamp()
-        params = {"timestamp": ts, "recvWindow": 10000}
-        query = urllib.parse.urlencode(params)
-        sig = sign(query, api_secret)
-        url = f"https://fapi.binance.com/fapi/v2/account?{query}&signature={sig}"
-        headers = {"X-MBX-APIKEY": api_key}
-
-        data = binance_api_request(url, headers=headers)
-        if not data:
+        account = get_account_state(api_key, api_secret)
+        if not account:
             logger.error("❌ Không lấy được thông tin ký quỹ từ Binance")
             return None, None, None
 
-        margin_balance = float(data.get("totalMarginBalance", 0.0))
-        maint_margin = float(data.get("totalMaintMargin", 0.0))
+        margin_balance = account.total_margin_balance
+        maint_margin = account.total_maint_margin
 
         # FIX 1: Chặn spam "maint margin" - nếu maint_margin <= 0 thì return luôn
         if maint_margin <= 0:
@@ -966,10 +2964,15 @@ def place_order(symbol, side, qty, api_key, api_secret):
             return None
             
         if "orderId" in result:
+            # Lệnh đã khớp: số dư/ký quỹ/vị thế thay đổi, lần đọc sau phải tải lại
+            invalidate_account_state(api_key)
+            _POSITION_BOOK.invalidate(api_key)
             logger.info(f"✅ place_order {symbol}: Đặt lệnh thành công, Order ID: {result['orderId']}")
             return result
         else:
             logger.error(f"❌ place_order {symbol}: Phản hồi không hợp lệ: {result}")
+            if _is_symbol_level_error(result):
+                _NEGATIVE_CACHE.record_failure(symbol, FAILURE_ORDER, result.get("msg", ""))
             return result
             
     except Exception as e:
@@ -1005,31 +3008,184 @@ def cancel_all_orders(symbol, api_key, api_secret):
         return False
 
 
-def get_current_price(symbol):
-    if not symbol:
-        return 0
-    return get_price_with_cache(symbol)
+def get_current_price(symbol, priority=None):
+    if not symbol:
+        return 0
+    return get_price_with_cache(symbol, priority)
+
+
+PositionSnapshot = namedtuple("PositionSnapshot", ["positions", "versions", "version", "fetched_at"])
+
+
+class PositionBook:
+    """
+    Ảnh chụp positionRisk dùng chung cho mọi bot cùng api key: MỘT lần gọi lấy
+    toàn bộ symbol, tra cứu O(1) theo symbol.
+    - version: tăng mỗi lần ảnh chụp được thay
+    - versions[symbol]: chỉ tăng khi vị thế của symbol đó thay đổi
+    - generation: tăng mỗi lần invalidate/cập nhật từ stream; lần tải bắt đầu ở
+      generation cũ không được ghi đè ảnh chụp (dữ liệu trước khi khớp lệnh)
+    """
+
+    _TRACKED_FIELDS = ("positionAmt", "entryPrice", "leverage")
+
+    def __init__(self, max_age=_POSITION_BOOK_MAX_AGE):
+        self.max_age = max_age
+        self._max_age_overrides = {}
+        self._books = {}
+        self._generations = {}  # api_key -> generation
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.fetch_count = 0
+        self.discarded_count = 0
+
+    def _fetch(self, api_key, api_secret, generation):
+        ts = get_synchronized_timestamp()
+        params = {"timestamp": ts, "recvWindow": 10000}
+        query = urllib.parse.urlencode(params)
+        sig = sign(query, api_secret)
+        url = f"https://fapi.binance.com/fapi/v2/positionRisk?{query}&signature={sig}"
+        headers = {"X-MBX-APIKEY": api_key}
+
+        # Không gộp với request đang chạy: nó có thể bắt đầu trước invalidate()
+        positions = binance_api_request(url, headers=headers, coalesce=False)
+        if positions is None:
+            return None
+        _APPLIED_LEVERAGE.update_from_positions(api_key, positions)
+        return self.publish(api_key, positions, generation=generation)
+
+    def publish(self, api_key, positions, generation=None):
+        """
+        Thay ảnh chụp của api key bằng danh sách vị thế mới, đánh version theo symbol.
+        generation: generation lúc bắt đầu tải; nếu đã bị invalidate từ đó thì
+        chỉ trả ảnh chụp cho các luồng đang chờ, không lưu lại.
+        """
+        with self._lock:
+            previous = self._books.get(api_key)
+            old_positions = previous.positions if previous else {}
+            old_versions = previous.versions if previous else {}
+            new_positions = {}
+            new_versions = {}
+            for pos in positions:
+                symbol = pos.get("symbol")
+                new_positions[symbol] = MappingProxyType(dict(pos))
+                old = old_positions.get(symbol)
+                changed = old is None or any(
+                    old.get(field) != pos.get(field) for field in self._TRACKED_FIELDS
+                )
+                new_versions[symbol] = old_versions.get(symbol, 0) + (1 if changed else 0)
+            snapshot = PositionSnapshot(
+                MappingProxyType(new_positions),
+                MappingProxyType(new_versions),
+                (previous.version if previous else 0) + 1,
+                time.time(),
+            )
+            self.fetch_count += 1
+            if generation is not None and generation != self._generations.get(api_key, 0):
+                self.discarded_count += 1
+                return snapshot
+            self._books[api_key] = snapshot
+        return snapshot
+
+    def get_snapshot(self, api_key, api_secret, max_age=None, force=False):
+        """Ảnh chụp còn đủ mới, tải lại (gộp các luồng) nếu cần; None nếu lỗi"""
+        if max_age is None:
+            max_age = self._max_age_overrides.get(api_key, self.max_age)
+        snapshot = self._books.get(api_key)
+        if not force and snapshot is not None and time.time() - snapshot.fetched_at <= max_age:
+            return snapshot
+        # Chỉ gộp với lần tải cùng generation: sau invalidate luôn tải mới
+        generation = self._generations.get(api_key, 0)
+        return self._flight.do(
+            (api_key, generation), lambda: self._fetch(api_key, api_secret, generation)
+        )
+
+    def get(self, symbol, api_key, api_secret, max_age=None):
+        snapshot = self.get_snapshot(api_key, api_secret, max_age=max_age)
+        return snapshot.positions.get(symbol.upper()) if snapshot else None
+
+    def open_symbols(self, api_key, api_secret, max_age=None):
+        """Các symbol đang có vị thế mở"""
+        snapshot = self.get_snapshot(api_key, api_secret, max_age=max_age)
+        if not snapshot:
+            return set()
+        return {
+            symbol
+            for symbol, pos in snapshot.positions.items()
+            if float(pos.get("positionAmt", 0)) != 0
+        }
+
+    def version(self, api_key, symbol=None):
+        snapshot = self._books.get(api_key)
+        if not snapshot:
+            return 0
+        if symbol is None:
+            return snapshot.version
+        return snapshot.versions.get(symbol.upper(), 0)
+
+    def set_max_age(self, api_key, max_age=None):
+        """Đổi tuổi tối đa cho một api key (None = mặc định), vd. khi có user data stream"""
+        with self._lock:
+            if max_age is None:
+                self._max_age_overrides.pop(api_key, None)
+            else:
+                self._max_age_overrides[api_key] = max_age
+
+    def apply_updates(self, api_key, updates):
+        """
+        Gộp thay đổi vị thế từ user data stream vào ảnh chụp hiện có.
+        Trả về False nếu chưa có ảnh chụp gốc (lần đọc sau sẽ tải đầy đủ).
+        """
+        with self._lock:
+            previous = self._books.get(api_key)
+            if previous is None:
+                return False
+            # Dữ liệu stream mới hơn mọi lần tải REST đang chạy
+            self._generations[api_key] = self._generations.get(api_key, 0) + 1
+            positions = dict(previous.positions)
+            versions = dict(previous.versions)
+            for update in updates:
+                symbol = update["symbol"]
+                old = positions.get(symbol, {})
+                merged = dict(old)
+                merged.update(update)
+                positions[symbol] = MappingProxyType(merged)
+                if any(str(old.get(field)) != str(merged.get(field)) for field in self._TRACKED_FIELDS):
+                    versions[symbol] = versions.get(symbol, 0) + 1
+            self._books[api_key] = PositionSnapshot(
+                MappingProxyType(positions),
+                MappingProxyType(versions),
+                previous.version + 1,
+                time.time(),
+            )
+        return True
+
+    def invalidate(self, api_key):
+        """Buộc lần đọc kế tiếp tải lại (sau khi đặt lệnh)"""
+        with self._lock:
+            self._generations[api_key] = self._generations.get(api_key, 0) + 1
+            previous = self._books.get(api_key)
+            if previous:
+                # Giữ version để lần tải sau vẫn so sánh được thay đổi
+                self._books[api_key] = previous._replace(fetched_at=0)
+
+
+_POSITION_BOOK = PositionBook()
+
+
+def get_position_book():
+    return _POSITION_BOOK
 
 
 def get_positions(symbol=None, api_key=None, api_secret=None):
     try:
-        ts = get_synchronized_timestamp()
-        params = {"timestamp": ts, "recvWindow": 10000}
-        if symbol:
-            params["symbol"] = symbol.upper()
-        query = urllib.parse.urlencode(params)
-        sig = sign(query, api_secret)
-        url = f"https://fapi.binance.com/fapi/v2/positionRisk?{query}&signature={sig}"
-        headers = {"X-MBX-APIKEY": api_key}
-
-        positions = binance_api_request(url, headers=headers)
-        if not positions:
+        snapshot = _POSITION_BOOK.get_snapshot(api_key, api_secret)
+        if not snapshot or not snapshot.positions:
             return []
         if symbol:
-            for pos in positions:
-                if pos["symbol"] == symbol.upper():
-                    return [pos]
-        return positions
+            pos = snapshot.positions.get(symbol.upper())
+            return [pos] if pos else []
+        return list(snapshot.positions.values())
     except Exception as e:
         logger.error(f"Lỗi vị thế: {str(e)}")
         return []
@@ -1156,55 +3312,32 @@ class SmartCoinFinder:
         self.api_secret = api_secret
         self.last_scan_time = 0
         self.scan_cooldown = 30  # Tăng cooldown để giảm spam API
-        self.analysis_cache = {}
-        self.cache_ttl = 30
-        self.last_positions_fetch = 0
-        self.cached_positions = set()
-        self.positions_cache_ttl = 15
-        self.last_ticker_fetch = 0
-        self.cached_ticker_data = []
-        self.ticker_cache_ttl = 30
+        self.analysis_cache = TTLCache(
+            "rsi_analysis", _ANALYSIS_CACHE_TTL, max_size=_ANALYSIS_CACHE_MAX_SIZE
+        )
 
     def _get_all_positions(self):
-        """Lấy tất cả vị thế và cache trong thời gian ngắn"""
-        current_time = time.time()
-        if current_time - self.last_positions_fetch < self.positions_cache_ttl:
-            return self.cached_positions.copy()
-        
+        """Các symbol đang có vị thế (đọc từ PositionBook dùng chung)"""
         try:
-            positions = get_positions(api_key=self.api_key, api_secret=self.api_secret)
-            symbol_set = set()
-            for pos in positions:
-                position_amt = float(pos.get("positionAmt", 0))
-                if abs(position_amt) > 0:
-                    symbol_set.add(pos.get("symbol", "").upper())
-            
-            self.cached_positions = symbol_set
-            self.last_positions_fetch = current_time
-            return symbol_set
+            return _POSITION_BOOK.open_symbols(self.api_key, self.api_secret)
         except Exception as e:
             logger.error(f"Lỗi lấy vị thế: {str(e)}")
             return set()
 
     def _get_ticker_data(self):
-        """Lấy dữ liệu ticker 24h với cache"""
-        current_time = time.time()
-        if (self.cached_ticker_data and 
-            current_time - self.last_ticker_fetch < self.ticker_cache_ttl):
-            return self.cached_ticker_data
-        
-        try:
-            data = get_ticker_24h_data()
-            self.cached_ticker_data = data
-            self.last_ticker_fetch = current_time
-            return data
-        except Exception as e:
-            logger.error(f"Lỗi lấy ticker data: {str(e)}")
-            return []
+        """Lấy dữ liệu ticker 24h (dùng chung cache toàn tiến trình)"""
+        return get_ticker_24h_data()
 
     def get_symbol_leverage(self, symbol):
         return get_max_leverage(symbol, self.api_key, self.api_secret)
 
+    def _prewarm_leverage(self, selected_symbol, valid_coins, leverage):
+        """Đặt sẵn đòn bẩy cho coin vừa chọn (và các ứng viên kế tiếp) ở luồng nền"""
+        candidates = [selected_symbol] + [
+            symbol for symbol, _ in valid_coins if symbol != selected_symbol
+        ]
+        prewarm_leverage(candidates, leverage, self.api_key, self.api_secret)
+
     def calculate_rsi(self, prices, period=14):
         if len(prices) < period + 1:
             return 50
@@ -1222,21 +3355,21 @@ class SmartCoinFinder:
 
     def get_rsi_signal(self, symbol, volume_threshold=10):
         try:
-            current_time = time.time()
             cache_key = f"{symbol}_{volume_threshold}"
 
-            if (
-                cache_key in self.analysis_cache
-                and current_time - self.analysis_cache[cache_key]["timestamp"]
-                < self.cache_ttl
-            ):
-                return self.analysis_cache[cache_key]["signal"]
+            cached = self.analysis_cache.get(cache_key, _CACHE_MISS)
+            if cached is not _CACHE_MISS:
+                return cached
 
             data = binance_api_request(
                 "https://fapi.binance.com/fapi/v1/klines",
                 params={"symbol": symbol, "interval": "5m", "limit": 15},
             )
             if not data or len(data) < 15:
+                if isinstance(data, list):
+                    _NEGATIVE_CACHE.record_failure(
+                        symbol, FAILURE_KLINES, f"chỉ có {len(data)} nến"
+                    )
                 return None
 
             prev_prev_candle, prev_candle, current_candle = data[-4], data[-3], data[-2]
@@ -1286,10 +3419,7 @@ class SmartCoinFinder:
             else:
                 result = None
 
-            self.analysis_cache[cache_key] = {
-                "signal": result,
-                "timestamp": current_time,
-            }
+            self.analysis_cache.set(cache_key, result)
             return result
 
         except Exception as e:
@@ -1357,6 +3487,8 @@ class SmartCoinFinder:
                     continue
                 if symbol in positions_set:
                     continue
+                if _NEGATIVE_CACHE.is_blocked(symbol):
+                    continue
 
                 max_lev = self.get_symbol_leverage(symbol)
                 if max_lev < required_leverage:
@@ -1381,6 +3513,7 @@ class SmartCoinFinder:
             if selected_symbol in positions_set:
                 return None
 
+            self._prewarm_leverage(selected_symbol, valid_coins, required_leverage)
             logger.info(f"🎯 Đã chọn coin theo volume: {selected_symbol}")
             return selected_symbol
 
@@ -1408,6 +3541,8 @@ class SmartCoinFinder:
                     continue
                 if symbol in positions_set:
                     continue
+                if _NEGATIVE_CACHE.is_blocked(symbol):
+                    continue
 
                 max_lev = self.get_symbol_leverage(symbol)
                 if max_lev < required_leverage:
@@ -1432,6 +3567,7 @@ class SmartCoinFinder:
             if selected_symbol in positions_set:
                 return None
 
+            self._prewarm_leverage(selected_symbol, valid_coins, required_leverage)
             logger.info(f"🎯 Đã chọn coin theo biến động: {selected_symbol}")
             return selected_symbol
 
@@ -1460,6 +3596,8 @@ class SmartCoinFinder:
                     continue
                 if symbol in positions_set:
                     continue
+                if _NEGATIVE_CACHE.is_blocked(symbol):
+                    continue
 
                 max_lev = self.get_symbol_leverage(symbol)
                 if max_lev < required_leverage:
@@ -1486,6 +3624,7 @@ class SmartCoinFinder:
                 if selected_symbol in positions_set:
                     return None
 
+                self._prewarm_leverage(selected_symbol, valid_coins, required_leverage)
                 logger.info(f"🎯 Đã chọn coin theo xu hướng: {selected_symbol}")
                 return selected_symbol
 
@@ -1498,6 +3637,9 @@ class SmartCoinFinder:
     def _check_symbol_conditions(self, symbol):
         """Kiểm tra các điều kiện bổ sung cho symbol"""
         try:
+            if _NEGATIVE_CACHE.is_blocked(symbol):
+                return False
+
             # Kiểm tra giá
             price = get_price_with_cache(symbol)
             if price < _MIN_PRICE:
@@ -1513,6 +3655,9 @@ class SmartCoinFinder:
                     if low_price > 0:
                         spread_percent = ((high_price - low_price) / low_price) * 100
                         if spread_percent > _MAX_SPREAD_PERCENT:
+                            _NEGATIVE_CACHE.record_failure(
+                                symbol, FAILURE_HIGH_SPREAD, f"spread {spread_percent:.1f}%"
+                            )
                             return False
                     break
                     
@@ -1537,95 +3682,717 @@ class SmartCoinFinder:
         return self.find_best_coin_by_volatility(excluded_coins, required_leverage)
 
 
-class WebSocketManager:
-    def __init__(self):
-        self.connections = {}
-        self.executor = ThreadPoolExecutor(max_workers=20)
+class _StreamConnection:
+    """
+    Một kết nối /stream chứa nhiều stream. Thêm/bớt stream bằng tin SUBSCRIBE /
+    UNSUBSCRIBE trên kết nối đang mở; khi kết nối lại thì đăng ký lại toàn bộ.
+    """
+
+    def __init__(self, conn_id, base_url, on_message):
+        self.conn_id = conn_id
+        self.base_url = base_url
+        self.streams = set()
+        self.connected = False
+        self._on_message = on_message
         self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._last_control_time = 0
+        self._request_id = 0
         self._stop_event = threading.Event()
-        self.price_cache = {}
-        self.last_price_update = {}
+        self._ws = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
 
-    def add_symbol(self, symbol, callback):
-        if not symbol:
-            return
-        symbol = symbol.upper()
+    def _send_control(self, method, streams):
+        ws = self._ws
+        if not streams or ws is None or not self.connected:
+            return False
+        with self._send_lock:
+            # Giữ nhịp dưới giới hạn tin điều khiển của sàn
+            wait = _WS_CONTROL_INTERVAL - (time.time() - self._last_control_time)
+            if wait > 0:
+                time.sleep(wait)
+            self._request_id += 1
+            try:
+                ws.send(json.dumps({"method": method, "params": sorted(streams), "id": self._request_id}))
+            except Exception as e:
+                logger.error(f"Lỗi gửi {method} WebSocket #{self.conn_id}: {str(e)}")
+                return False
+            finally:
+                self._last_control_time = time.time()
+        return True
+
+    def reserve(self, stream):
+        """Ghi nhận stream thuộc kết nối này (chưa gửi SUBSCRIBE)"""
         with self._lock:
-            if symbol not in self.connections:
-                self._create_connection(symbol, callback)
+            if stream in self.streams:
+                return False
+            self.streams.add(stream)
+            return True
 
-    def _create_connection(self, symbol, callback):
-        if self._stop_event.is_set():
-            return
+    def release(self, stream):
+        with self._lock:
+            if stream not in self.streams:
+                return False
+            self.streams.discard(stream)
+            return True
 
-        streams = [f"{symbol.lower()}@trade"]
-        url = f"wss://fstream.binance.com/stream?streams={'/'.join(streams)}"
+    def subscribe(self, streams):
+        # Chưa kết nối thì _on_open sẽ đăng ký toàn bộ stream đã ghi nhận
+        return self._send_control("SUBSCRIBE", streams)
+
+    def unsubscribe(self, streams):
+        return self._send_control("UNSUBSCRIBE", streams)
+
+    def _on_open(self, ws):
+        self.connected = True
+        with self._lock:
+            streams = list(self.streams)
+        self._send_control("SUBSCRIBE", streams)
+        logger.info(f"🔗 WebSocket #{self.conn_id} đã kết nối ({len(streams)} stream)")
+
+    def _on_error(self, ws, error):
+        logger.error(f"Lỗi WebSocket #{self.conn_id}: {str(error)}")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._ws = websocket.WebSocketApp(
+                f"{self.base_url}/stream",
+                on_open=self._on_open,
+                on_message=self._on_message,
+                on_error=self._on_error,
+            )
+            try:
+                self._ws.run_forever(ping_interval=180, ping_timeout=10)
+            except Exception as e:
+                logger.error(f"Lỗi WebSocket #{self.conn_id}: {str(e)}")
+            self.connected = False
+            if not self._stop_event.is_set():
+                logger.info(f"WebSocket #{self.conn_id} đã đóng, kết nối lại sau {_WS_RECONNECT_DELAY}s")
+            self._stop_event.wait(_WS_RECONNECT_DELAY)
 
-        def on_message(ws, message):
+    def close(self):
+        self._stop_event.set()
+        ws = self._ws
+        if ws is not None:
             try:
-                data = json.loads(message)
-                if "data" in data:
-                    symbol = data["data"]["s"]
-                    price = float(data["data"]["p"])
-                    current_time = time.time()
+                ws.close()
+            except Exception as e:
+                logger.error(f"Lỗi đóng WebSocket #{self.conn_id}: {str(e)}")
 
-                    if (
-                        symbol in self.last_price_update
-                        and current_time - self.last_price_update[symbol] < 0.1
-                    ):
-                        return
 
-                    self.last_price_update[symbol] = current_time
-                    self.price_cache[symbol] = price
-                    self.executor.submit(callback, price)
+PriceTick = namedtuple("PriceTick", ["price", "seq", "event_time", "receive_time"])
+
+
+class PriceMailbox:
+    """
+    Hộp thư một ô của một bên đăng ký: chỉ giữ tick MỚI NHẤT. Tick chưa kịp xử lý
+    bị ghi đè (không dồn hàng đợi), nên callback luôn nhận giá mới nhất và bộ nhớ
+    không tăng khi callback chậm.
+    """
+
+    def __init__(self, callback, dispatcher):
+        self.callback = callback
+        self._dispatcher = dispatcher
+        self._lock = threading.Lock()
+        self._tick = None
+        self._seq = 0
+        self._delivered_seq = 0
+        self._scheduled = False
+        self.dropped = 0  # Số tick bị ghi đè trước khi kịp giao
+
+    def put(self, price, event_time=None):
+        with self._lock:
+            if self._tick is not None and self._tick.seq != self._delivered_seq:
+                self.dropped += 1
+            self._seq += 1
+            self._tick = PriceTick(price, self._seq, event_time, time.time())
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._dispatcher.schedule(self)
+
+    def latest(self):
+        return self._tick
+
+    def drain(self):
+        """Giao tick mới nhất cho tới khi không còn tick mới (chỉ một luồng chạy mỗi lúc)"""
+        while True:
+            with self._lock:
+                tick = self._tick
+                if tick is None or tick.seq == self._delivered_seq:
+                    self._scheduled = False
+                    return
+                self._delivered_seq = tick.seq
+            try:
+                self.callback(tick.price)
             except Exception as e:
-                logger.error(f"Lỗi tin nhắn WebSocket {symbol}: {str(e)}")
+                logger.error(f"Lỗi callback giá: {str(e)}")
 
-        def on_error(ws, error):
-            logger.error(f"Lỗi WebSocket {symbol}: {str(error)}")
-            if not self._stop_event.is_set():
-                time.sleep(5)
-                self._reconnect(symbol, callback)
 
-        def on_close(ws, close_status_code, close_msg):
-            logger.info(
-                f"WebSocket đã đóng {symbol}: {close_status_code} - {close_msg}"
-            )
-            if not self._stop_event.is_set() and symbol in self.connections:
-                time.sleep(5)
-                self._reconnect(symbol, callback)
+class MailboxDispatcher:
+    """Các luồng worker lấy hộp thư vừa có tick mới và gọi callback"""
 
-        ws = websocket.WebSocketApp(
-            url, on_message=on_message, on_error=on_error, on_close=on_close
-        )
-        thread = threading.Thread(target=ws.run_forever, daemon=True)
-        thread.start()
+    def __init__(self, workers=_WS_DISPATCH_WORKERS):
+        # Mỗi hộp thư nằm trong hàng đợi tối đa một lần -> hàng đợi bị chặn bởi số bên đăng ký
+        self._ready = queue.SimpleQueue()
+        self._threads = [
+            threading.Thread(target=self._worker, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def schedule(self, mailbox):
+        self._ready.put(mailbox)
+
+    def _worker(self):
+        while True:
+            mailbox = self._ready.get()
+            if mailbox is None:
+                return
+            mailbox.drain()
+
+    def stop(self):
+        for _ in self._threads:
+            self._ready.put(None)
+
+
+PriceQuote = namedtuple(
+    "PriceQuote",
+    ["last", "mark", "bid", "ask", "event_time", "receive_time", "mark_event_time", "mark_receive_time"],
+)
+PriceBoardSnapshot = namedtuple("PriceBoardSnapshot", ["symbols", "values", "taken_at"])
 
-        self.connections[symbol] = {"ws": ws, "thread": thread, "callback": callback}
-        logger.info(f"🔗 WebSocket đã khởi động cho {symbol}")
 
-    def _reconnect(self, symbol, callback):
-        logger.info(f"Đang kết nối lại WebSocket cho {symbol}")
-        self.remove_symbol(symbol)
-        self._create_connection(symbol, callback)
+class PriceBoard:
+    """
+    Bảng giá dùng chung: mỗi symbol được gán một id nguyên cố định, các trường
+    giá nằm trong mảng NumPy cấp phát sẵn (một hàng mỗi symbol, một cột mỗi trường).
+
+    Ghi tuần tự qua _write_lock; đọc không khóa kiểu seqlock: số thứ tự của hàng
+    lẻ khi đang ghi, đọc lại nếu số thứ tự thay đổi trong lúc đọc, nên mọi trường
+    của một lần đọc luôn thuộc cùng một lần ghi.
+    """
+
+    LAST, MARK, BID, ASK, EVENT_TIME, RECEIVE_TIME, MARK_EVENT_TIME, MARK_RECEIVE_TIME = range(8)
+    FIELDS = PriceQuote._fields
+
+    def __init__(self, capacity=_PRICE_BOARD_CAPACITY):
+        self._write_lock = threading.Lock()
+        self._ids = {}  # symbol -> id
+        self._symbols = []  # id -> symbol
+        # (giá trị, số thứ tự) thay cùng lúc khi nới mảng
+        self._arrays = self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        values = np.full((capacity, len(self.FIELDS)), np.nan, dtype=np.float64)
+        return values, np.zeros(capacity, dtype=np.int64)
+
+    def intern(self, symbol):
+        """Id của symbol, cấp id mới nếu chưa có"""
+        symbol_id = self._ids.get(symbol)
+        if symbol_id is not None:
+            return symbol_id
+        with self._write_lock:
+            return self._intern_locked(symbol)
+
+    def _intern_locked(self, symbol):
+        symbol_id = self._ids.get(symbol)
+        if symbol_id is not None:
+            return symbol_id
+        values, seq = self._arrays
+        symbol_id = len(self._symbols)
+        if symbol_id >= len(seq):
+            grown_values, grown_seq = self._allocate(len(seq) * 2)
+            grown_values[: len(seq)] = values
+            grown_seq[: len(seq)] = seq
+            self._arrays = (grown_values, grown_seq)
+        self._symbols.append(symbol)
+        self._ids[symbol] = symbol_id
+        return symbol_id
+
+    def symbol_id(self, symbol):
+        """Id đã cấp của symbol, None nếu bảng chưa từng thấy symbol"""
+        return self._ids.get(symbol)
+
+    def update(self, symbol, kind, price, bid=None, ask=None, event_time=None, receive_time=None):
+        """Ghi một tick: mark price vào cột mark, trade/aggTrade/bookTicker vào cột giá gần nhất"""
+        receive_time = time.time() if receive_time is None else receive_time
+        event_time = np.nan if event_time is None else event_time
+        with self._write_lock:
+            symbol_id = self._intern_locked(symbol)
+            values, seq = self._arrays
+            row = values[symbol_id]
+            seq[symbol_id] += 1  # Lẻ: đang ghi
+            if kind == STREAM_MARK_PRICE:
+                row[self.MARK] = price
+                row[self.MARK_EVENT_TIME] = event_time
+                row[self.MARK_RECEIVE_TIME] = receive_time
+            else:
+                row[self.LAST] = price
+                if bid is not None:
+                    row[self.BID] = bid
+                    row[self.ASK] = ask
+                row[self.EVENT_TIME] = event_time
+                row[self.RECEIVE_TIME] = receive_time
+            seq[symbol_id] += 1
+
+    def read_id(self, symbol_id):
+        """PriceQuote nhất quán của một id (trường chưa có giá trị là NaN)"""
+        while True:
+            values, seq = self._arrays
+            before = seq[symbol_id]
+            if before & 1:
+                time.sleep(0)
+                continue
+            row = values[symbol_id].tolist()
+            if seq[symbol_id] == before and self._arrays[1] is seq:
+                return PriceQuote._make(row)
+
+    def read(self, symbol):
+        symbol_id = self._ids.get(symbol)
+        if symbol_id is None:
+            return None
+        return self.read_id(symbol_id)
+
+    def snapshot(self, max_age=None):
+        """
+        Bản chụp toàn bộ bảng (mảng copy, cột theo FIELDS). Với max_age, giá cũ hơn
+        max_age giây bị thay bằng NaN để tính toán vector không dùng nhầm giá cũ.
+        """
+        symbols = tuple(self._symbols)
+        values, seq = self._arrays
+        count = len(symbols)
+        before = seq[:count].copy()
+        copied = values[:count].copy()
+        torn = np.nonzero((before != seq[:count]) | (before & 1))[0]
+        for symbol_id in torn:
+            copied[symbol_id] = self.read_id(symbol_id)
+
+        taken_at = time.time()
+        if max_age is not None:
+            with np.errstate(invalid="ignore"):
+                stale = ~(taken_at - copied[:, self.RECEIVE_TIME] <= max_age)
+                stale_mark = ~(taken_at - copied[:, self.MARK_RECEIVE_TIME] <= max_age)
+            copied[stale, self.LAST] = np.nan
+            copied[stale, self.BID] = np.nan
+            copied[stale, self.ASK] = np.nan
+            copied[stale_mark, self.MARK] = np.nan
+        return PriceBoardSnapshot(symbols, copied, taken_at)
+
+
+class WebSocketManager:
+    """
+    Quản lý giá realtime: gộp các symbol vào ít kết nối /stream (tối đa
+    _WS_MAX_STREAMS_PER_CONNECTION stream mỗi kết nối) và chuyển frame tới các
+    bên đăng ký theo symbol. Thêm/bớt symbol không làm mở lại kết nối.
+    Mỗi bên đăng ký chọn loại stream cần (STREAM_*); mỗi symbol chỉ đăng ký
+    tập stream rẻ nhất đáp ứng được tất cả các bên.
+    """
 
-    def remove_symbol(self, symbol):
+    def __init__(self, base_url=None, max_streams_per_connection=_WS_MAX_STREAMS_PER_CONNECTION):
+        self.base_url = base_url or _FUTURES_WS_BASE
+        self.max_streams_per_connection = max_streams_per_connection
+        self.connections = {}  # conn_id -> _StreamConnection
+        self.dispatcher = MailboxDispatcher()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._subscribers = defaultdict(dict)  # symbol -> {owner: (loại stream, PriceMailbox)}
+        self._stream_connection = {}  # tên stream -> conn_id
+        self._next_conn_id = 0
+        # Giá gần nhất (trade/aggTrade, hoặc giữa bid/ask), mark price, bid/ask theo symbol
+        self.price_board = PriceBoard()
+
+    @staticmethod
+    def _stream_name(symbol, kind):
+        return f"{symbol.lower()}@{kind}"
+
+    @staticmethod
+    def _required_kinds(kinds):
+        """Tập loại stream nhỏ nhất đáp ứng mọi nhu cầu trong kinds"""
+        return {
+            kind
+            for kind in kinds
+            if not any(kind in _STREAM_SATISFIES.get(other, ()) for other in kinds)
+        }
+
+    def _connection_with_capacity(self, preferred=()):
+        for conn in list(preferred) + list(self.connections.values()):
+            if len(conn.streams) < self.max_streams_per_connection:
+                return conn
+        self._next_conn_id += 1
+        conn = _StreamConnection(self._next_conn_id, self.base_url, self._on_message)
+        self.connections[conn.conn_id] = conn
+        return conn
+
+    def _sync_symbol(self, symbol):
+        """
+        (Gọi khi giữ self._lock) Đưa tập stream của symbol về đúng nhu cầu hiện tại.
+        Trả về các thao tác mạng để thực hiện sau khi nhả khóa.
+        """
+        kinds = {kind for kind, _ in self._subscribers.get(symbol, {}).values()}
+        wanted = {self._stream_name(symbol, kind) for kind in self._required_kinds(kinds)}
+        prefix = f"{symbol.lower()}@"
+        current = {name for name in self._stream_connection if name.startswith(prefix)}
+        # Nhả stream cũ trước: khi đổi loại stream trên kết nối đã đầy, stream mới
+        # dùng lại chỗ vừa trống thay vì mở thêm socket
+        released = []
+        for name in current - wanted:
+            conn = self.connections.get(self._stream_connection.pop(name))
+            if conn is None:
+                continue
+            conn.release(name)
+            released.append((conn, name))
+        subscribes = []
+        for name in wanted - current:
+            conn = self._connection_with_capacity(conn for conn, _ in released)
+            conn.reserve(name)
+            self._stream_connection[name] = conn.conn_id
+            subscribes.append(("subscribe", conn, name))
+        actions = []
+        for conn, name in released:
+            if conn.streams:
+                actions.append(("unsubscribe", conn, name))
+            elif self.connections.pop(conn.conn_id, None) is not None:
+                # Kết nối không còn stream nào: đóng hẳn thay vì giữ socket rỗng
+                actions.append(("close", conn, name))
+        return actions + subscribes
+
+    @staticmethod
+    def _apply(actions):
+        for action, conn, name in actions:
+            if action == "subscribe":
+                conn.subscribe([name])
+            elif action == "unsubscribe":
+                conn.unsubscribe([name])
+            else:
+                conn.close()
+
+    def add_symbol(self, symbol, callback, owner=None, kind=STREAM_TRADE):
+        """
+        Đăng ký nhận giá của symbol qua loại stream kind (STREAM_*);
+        owner phân biệt các bên cùng theo dõi một symbol
+        """
+        if not symbol or self._stop_event.is_set():
+            return
+        symbol = symbol.upper()
+        with self._lock:
+            self._subscribers[symbol][owner] = (kind, PriceMailbox(callback, self.dispatcher))
+            actions = self._sync_symbol(symbol)
+        self._apply(actions)
+        if actions:
+            logger.info(f"🔗 Đã đăng ký {kind} cho {symbol}")
+
+    def remove_symbol(self, symbol, owner=None):
+        """Hủy đăng ký của owner (None = mọi bên); hủy stream không còn ai cần"""
         if not symbol:
             return
         symbol = symbol.upper()
         with self._lock:
-            if symbol in self.connections:
+            subscribers = self._subscribers.get(symbol)
+            if subscribers is not None:
+                if owner is None:
+                    subscribers.clear()
+                else:
+                    subscribers.pop(owner, None)
+                if not subscribers:
+                    self._subscribers.pop(symbol, None)
+            actions = self._sync_symbol(symbol)
+        self._apply(actions)
+        if actions:
+            logger.info(f"WebSocket đã hủy đăng ký {symbol}")
+
+    @staticmethod
+    def _parse_frame(message):
+        """
+        (loại stream, symbol, giá, bid, ask, thời gian sự kiện) từ frame,
+        None nếu không phải frame giá
+        """
+        # Chỉ cần vài trường vô hướng: trích trực tiếp, không giải mã cả frame
+        head = extract_json_fields(message, ("e", "E", "s"))
+        if head is None:
+            data = json_loads(message).get("data")
+            if not data:
+                return None  # Phản hồi SUBSCRIBE/UNSUBSCRIBE
+            kind = _STREAM_EVENT_TYPES.get(data.get("e"))
+            event_time = data.get("E")
+            if kind == STREAM_BOOK_TICKER:
+                bid, ask = float(data["b"]), float(data["a"])
+                return kind, data["s"], (bid + ask) / 2, bid, ask, event_time
+            return (kind, data["s"], float(data["p"]), None, None, event_time) if kind else None
+
+        kind = _STREAM_EVENT_TYPES.get(head[0])
+        if kind is None:
+            return None
+        event_time = int(head[1])
+        if kind == STREAM_BOOK_TICKER:
+            bid, ask = (float(v) for v in extract_json_fields(message, ("b", "a")))
+            return kind, head[2], (bid + ask) / 2, bid, ask, event_time
+        price = float(extract_json_fields(message, ("p",))[0])
+        return kind, head[2], price, None, None, event_time
+
+    def _on_message(self, ws, message):
+        try:
+            frame = self._parse_frame(message)
+            if frame is None:
+                return
+            kind, symbol, price, bid, ask, event_time = frame
+            self.price_board.update(symbol, kind, price, bid, ask, event_time)
+
+            # Hộp thư chỉ giữ tick mới nhất: không cần bỏ bớt tick ở đây
+            for wanted, mailbox in list(self._subscribers.get(symbol, {}).values()):
+                if wanted == kind or wanted in _STREAM_SATISFIES.get(kind, ()):
+                    mailbox.put(price, event_time)
+        except Exception as e:
+            logger.error(f"Lỗi tin nhắn WebSocket: {str(e)}")
+
+    def stop(self):
+        self._stop_event.set()
+        with self._lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+            self._subscribers.clear()
+            self._stream_connection.clear()
+        for conn in connections:
+            conn.close()
+        self.dispatcher.stop()
+
+
+class UserDataStream:
+    """
+    User data stream của một api key:
+    - Tạo listenKey (POST) và gia hạn (PUT) mỗi 30 phút, tạo lại khi hết hạn
+    - Nhận ACCOUNT_UPDATE / ORDER_TRADE_UPDATE / MARGIN_CALL qua websocket và cập
+      nhật PositionBook, AccountState, bảng lệnh trong bộ nhớ
+    Khi stream đang kết nối, PositionBook/AccountState chỉ còn đối soát REST thưa.
+    """
+
+    def __init__(self, api_key, api_secret, rest_base=None, ws_base=None):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.rest_base = rest_base or _FUTURES_REST_BASE
+        self.ws_base = ws_base or _FUTURES_WS_BASE
+        self.listen_key = None
+        self.connected = False
+        self.last_event_time = 0
+        self.event_counts = defaultdict(int)
+        self._orders = OrderedDict()  # orderId -> trạng thái lệnh mới nhất
+        self._lock = threading.Lock()
+        self._order_updated = threading.Condition(self._lock)
+        self._stop_event = threading.Event()
+        self._ws = None
+        self._thread = None
+        self._keepalive_thread = None
+
+    # ---------- listenKey ----------
+
+    def _listen_key_request(self, method):
+        url = f"{self.rest_base}/fapi/v1/listenKey"
+        return binance_api_request(url, method=method, headers={"X-MBX-APIKEY": self.api_key})
+
+    def _create_listen_key(self):
+        data = self._listen_key_request("POST")
+        if data and "listenKey" in data:
+            return data["listenKey"]
+        logger.error(f"❌ Không tạo được listenKey: {data}")
+        return None
+
+    def _keepalive_loop(self):
+        while not self._stop_event.wait(_USER_STREAM_KEEPALIVE):
+            if not self.listen_key:
+                continue
+            data = self._listen_key_request("PUT")
+            if data is None or "code" in data:
+                # listenKey đã mất: đóng socket để vòng chạy chính tạo key mới
+                logger.warning(f"⚠️ Gia hạn listenKey thất bại, kết nối lại: {data}")
+                self._close_socket()
+
+    # ---------- websocket ----------
+
+    def _on_open(self, ws):
+        self.connected = True
+        _POSITION_BOOK.set_max_age(self.api_key, _USER_STREAM_POSITION_MAX_AGE)
+        _ACCOUNT_STATE.set_max_age(self.api_key, _USER_STREAM_ACCOUNT_MAX_AGE)
+        # Có thể đã lỡ sự kiện khi mất kết nối: đối soát lại một lần bằng REST
+        _POSITION_BOOK.invalidate(self.api_key)
+        _ACCOUNT_STATE.invalidate(self.api_key)
+        logger.info("🔗 User data stream đã kết nối")
+
+    def _on_disconnect(self):
+        self.connected = False
+        _POSITION_BOOK.set_max_age(self.api_key, None)
+        _ACCOUNT_STATE.set_max_age(self.api_key, None)
+        with self._order_updated:
+            self._order_updated.notify_all()
+
+    def _on_message(self, ws, message):
+        try:
+            self.handle_event(json_loads(message))
+        except Exception as e:
+            logger.error(f"Lỗi xử lý user data stream: {str(e)}")
+
+    def _on_error(self, ws, error):
+        logger.error(f"Lỗi user data stream: {str(error)}")
+
+    def _close_socket(self):
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception as e:
+                logger.error(f"Lỗi đóng user data stream: {str(e)}")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.listen_key = self._create_listen_key()
+            if self.listen_key:
+                self._ws = websocket.WebSocketApp(
+                    f"{self.ws_base}/ws/{self.listen_key}",
+                    on_open=self._on_open,
+                    on_message=self._on_message,
+                    on_error=self._on_error,
+                )
                 try:
-                    self.connections[symbol]["ws"].close()
+                    self._ws.run_forever(ping_interval=180, ping_timeout=10)
                 except Exception as e:
-                    logger.error(f"Lỗi đóng WebSocket {symbol}: {str(e)}")
-                del self.connections[symbol]
-                logger.info(f"WebSocket đã xóa cho {symbol}")
+                    logger.error(f"Lỗi user data stream: {str(e)}")
+                finally:
+                    self._ws = None
+                    self._on_disconnect()
+                if not self._stop_event.is_set():
+                    logger.warning("⚠️ User data stream mất kết nối, đang kết nối lại")
+            self._stop_event.wait(_USER_STREAM_RECONNECT_DELAY)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+        self._keepalive_thread.start()
 
     def stop(self):
         self._stop_event.set()
-        for symbol in list(self.connections.keys()):
-            self.remove_symbol(symbol)
+        self._close_socket()
+        if self.listen_key:
+            self._listen_key_request("DELETE")
+
+    # ---------- sự kiện ----------
+
+    def handle_event(self, event):
+        event_type = event.get("e")
+        self.last_event_time = time.time()
+        self.event_counts[event_type] += 1
+        if event_type == "ACCOUNT_UPDATE":
+            self._handle_account_update(event)
+        elif event_type == "ORDER_TRADE_UPDATE":
+            self._handle_order_update(event)
+        elif event_type == "MARGIN_CALL":
+            self._handle_margin_call(event)
+        elif event_type == "listenKeyExpired":
+            logger.warning("⚠️ listenKey hết hạn, tạo lại")
+            self._close_socket()
+
+    def _handle_account_update(self, event):
+        account = event.get("a", {})
+        updates = []
+        for pos in account.get("P", []):
+            # Bot chạy chế độ một chiều (BOTH); bỏ qua chân LONG/SHORT của hedge mode
+            if pos.get("ps", "BOTH") != "BOTH":
+                continue
+            updates.append({
+                "symbol": pos["s"],
+                "positionAmt": pos.get("pa", "0"),
+                "entryPrice": pos.get("ep", "0"),
+                "unRealizedProfit": pos.get("up", "0"),
+                "marginType": pos.get("mt", ""),
+            })
+        if updates and not _POSITION_BOOK.apply_updates(self.api_key, updates):
+            _POSITION_BOOK.invalidate(self.api_key)
+        if account.get("B"):
+            # Sự kiện chỉ có walletBalance, không có availableBalance/tổng ký quỹ:
+            # đánh dấu để lần đọc sau tải ảnh chụp đầy đủ
+            _ACCOUNT_STATE.invalidate(self.api_key)
+
+    def _handle_order_update(self, event):
+        order = event.get("o", {})
+        if "i" not in order:
+            return
+        state = MappingProxyType({
+            "orderId": order["i"],
+            "clientOrderId": order.get("c"),
+            "symbol": order.get("s"),
+            "side": order.get("S"),
+            "type": order.get("o"),
+            "status": order.get("X"),
+            "executionType": order.get("x"),
+            "executedQty": float(order.get("z", 0)),
+            "avgPrice": float(order.get("ap", 0)),
+            "lastFilledPrice": float(order.get("L", 0)),
+            "eventTime": event.get("E", 0),
+        })
+        with self._order_updated:
+            self._orders.pop(order["i"], None)
+            self._orders[order["i"]] = state
+            while len(self._orders) > _USER_STREAM_MAX_ORDERS:
+                self._orders.popitem(last=False)
+            self._order_updated.notify_all()
+
+    def _handle_margin_call(self, event):
+        symbols = ", ".join(p.get("s", "?") for p in event.get("p", []))
+        logger.warning(f"🚨 MARGIN CALL: {symbols} - số dư ký quỹ chéo {event.get('cw', '?')}")
+        _ACCOUNT_STATE.invalidate(self.api_key)
+
+    def get_order(self, order_id):
+        return self._orders.get(order_id)
+
+    def wait_for_order(self, order_id, timeout):
+        """
+        Chờ lệnh tới trạng thái cuối (FILLED, CANCELED...). Trả về trạng thái lệnh,
+        hoặc None nếu hết thời gian/stream mất kết nối.
+        """
+        deadline = time.time() + timeout
+        with self._order_updated:
+            while True:
+                state = self._orders.get(order_id)
+                if state and state["status"] in ("FILLED", "CANCELED", "EXPIRED", "REJECTED"):
+                    return state
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.connected:
+                    return None
+                self._order_updated.wait(remaining)
+
+
+_USER_STREAMS = {}
+_USER_STREAMS_LOCK = threading.Lock()
+
+
+def start_user_data_stream(api_key, api_secret):
+    """Khởi động (một lần cho mỗi api key) user data stream"""
+    with _USER_STREAMS_LOCK:
+        stream = _USER_STREAMS.get(api_key)
+        if stream is None:
+            stream = UserDataStream(api_key, api_secret)
+            _USER_STREAMS[api_key] = stream
+    stream.start()
+    return stream
+
+
+def get_user_data_stream(api_key):
+    return _USER_STREAMS.get(api_key)
+
+
+def wait_for_order_update(api_key, order_id, timeout=1.0):
+    """
+    Chờ sự kiện khớp lệnh từ user data stream; không có stream thì chờ đủ
+    timeout như trước (để positionRisk kịp cập nhật).
+    """
+    stream = _USER_STREAMS.get(api_key)
+    if stream is None or not stream.connected:
+        time.sleep(timeout)
+        return None
+    return stream.wait_for_order(order_id, timeout)
 
 
 class BaseBot:
@@ -1776,6 +4543,7 @@ class BaseBot:
                 f"🟢 Bot {strategy_name} đã khởi động | 🔄 Động | {strategy_info} | 1 coin | Đòn bẩy: {lev}x | Vốn: {percent}% | TP/SL: {tp}%/{sl}%{roi_info}{pyramiding_info}"
             )
 
+    @track_api_cost(CALL_SITE_OTHER)
     def _run(self):
         """Vòng lặp chính - CHỈ CHUYỂN QUYỀN KHI ĐÃ VÀO LỆNH THÀNH CÔNG"""
         while not self._stop:
@@ -1853,6 +4621,7 @@ class BaseBot:
                     self.last_error_log_time = time.time()
                 time.sleep(5)
 
+    @track_api_cost(CALL_SITE_SCAN)
     def _process_single_symbol(self, symbol):
         """Xử lý một symbol duy nhất - TRẢ VỀ True NẾU VỪA VÀO LỆNH THÀNH CÔNG"""
         try:
@@ -2096,6 +4865,7 @@ class BaseBot:
             self.log(f"❌ Lỗi kiểm tra nhồi lệnh {symbol}: {str(e)}")
             return False
 
+    @track_api_cost(CALL_SITE_ORDER)
     def _pyramid_order(self, symbol):
         """Thực hiện lệnh nhồi (thêm lệnh cùng chiều)"""
         try:
@@ -2241,6 +5011,7 @@ class BaseBot:
             self.log(f"❌ Lỗi kiểm tra thoát thông minh {symbol}: {str(e)}")
             return False
 
+    @track_api_cost(CALL_SITE_SCAN)
     def _find_and_add_new_coin(self):
         """Tìm và thêm coin mới - TRẢ VỀ TÊN COIN HOẶC NONE"""
         try:
@@ -2316,8 +5087,12 @@ class BaseBot:
 
         self.active_symbols.append(symbol)
         self.coin_manager.register_coin(symbol)
+        # TP/SL tính theo mark price: stream 1 tin/giây thay cho từng giao dịch
         self.ws_manager.add_symbol(
-            symbol, lambda price, sym=symbol: self._handle_price_update(price, sym)
+            symbol,
+            lambda price, sym=symbol: self._handle_price_update(price, sym),
+            owner=self.bot_id,
+            kind=STREAM_MARK_PRICE,
         )
 
         self._check_symbol_position(symbol)
@@ -2330,14 +5105,29 @@ class BaseBot:
         if symbol in self.symbol_data:
             self.symbol_data[symbol]["current_price"] = price
 
-    def get_current_price(self, symbol):
-        if (
-            symbol in self.ws_manager.price_cache
-            and time.time() - self.ws_manager.last_price_update.get(symbol, 0) < 5
-        ):
-            return self.ws_manager.price_cache[symbol]
-        return get_current_price(symbol)
-
+    def get_current_price(self, symbol, priority=PRIORITY_ACCOUNT):
+        """
+        Giá cho bot đang quản lý vị thế: REST dự phòng không xếp chung hàng với
+        request quét (vào/đóng lệnh truyền PRIORITY_ORDER)
+        """
+        quote = self.ws_manager.price_board.read(symbol)
+        if quote is not None:
+            now = time.time()
+            if now - quote.receive_time < _WS_PRICE_MAX_AGE:
+                return quote.last
+            # Bot chỉ đăng ký mark price: dùng tạm khi chưa có giá giao dịch
+            if now - quote.mark_receive_time < _WS_PRICE_MAX_AGE:
+                return quote.mark
+        return get_current_price(symbol, priority)
+
+    def get_mark_price(self, symbol):
+        """Mark price cho kiểm tra TP/SL: không được bị bỏ khi API quá tải"""
+        quote = self.ws_manager.price_board.read(symbol)
+        if quote is not None and time.time() - quote.mark_receive_time < _WS_PRICE_MAX_AGE:
+            return quote.mark
+        return get_mark_price_with_cache(symbol, PRIORITY_ORDER)
+
+    @track_api_cost(CALL_SITE_POSITION)
     def _check_symbol_position(self, symbol):
         try:
             positions = get_positions(symbol, self.api_key, self.api_secret)
@@ -2420,6 +5210,7 @@ class BaseBot:
                 }
             )
 
+    @track_api_cost(CALL_SITE_ORDER)
     def _open_symbol_position(self, symbol, side):
         try:
             if self.coin_finder.has_existing_position(symbol):
@@ -2431,25 +5222,6 @@ class BaseBot:
             if self.symbol_data[symbol]["position_open"]:
                 return False
 
-            # Kiểm tra và điều chỉnh leverage hợp lệ
-            current_leverage = self.coin_finder.get_symbol_leverage(symbol)
-            if current_leverage < self.lev:
-                self.log(
-                    f"⚠️ {symbol} - Đòn bẩy yêu cầu {self.lev}x > max {current_leverage}x, "
-                    f"điều chỉnh xuống {current_leverage}x"
-                )
-                adjusted_lev = current_leverage
-            else:
-                adjusted_lev = self.lev
-
-            if not set_leverage(symbol, adjusted_lev, self.api_key, self.api_secret):
-                self.log(f"❌ {symbol} - Không thể cài đặt đòn bẩy")
-                self.stop_symbol(symbol)
-                return False
-
-            # Lưu đòn bẩy đã điều chỉnh
-            self.symbol_data[symbol]['leverage'] = adjusted_lev
-
             total_balance, available_balance = get_total_and_available_balance(
                 self.api_key, self.api_secret
             )
@@ -2472,7 +5244,30 @@ class BaseBot:
                 )
                 return False
 
-            current_price = self.get_current_price(symbol)
+            # Kiểm tra và điều chỉnh leverage hợp lệ theo bracket của notional sẽ mở
+            current_leverage = get_leverage_brackets(
+                self.api_key, self.api_secret
+            ).leverage_for_margin(symbol, required_usd, self.lev)
+            if current_leverage is None:
+                current_leverage = self.coin_finder.get_symbol_leverage(symbol)
+            if current_leverage < self.lev:
+                self.log(
+                    f"⚠️ {symbol} - Đòn bẩy yêu cầu {self.lev}x > max {current_leverage}x, "
+                    f"điều chỉnh xuống {current_leverage}x"
+                )
+                adjusted_lev = current_leverage
+            else:
+                adjusted_lev = self.lev
+
+            if not set_leverage(symbol, adjusted_lev, self.api_key, self.api_secret):
+                self.log(f"❌ {symbol} - Không thể cài đặt đòn bẩy")
+                self.stop_symbol(symbol)
+                return False
+
+            # Lưu đòn bẩy đã điều chỉnh
+            self.symbol_data[symbol]['leverage'] = adjusted_lev
+
+            current_price = self.get_current_price(symbol, PRIORITY_ORDER)
             if current_price <= 0:
                 self.log(f"❌ {symbol} - Lỗi giá")
                 self.stop_symbol(symbol)
@@ -2491,6 +5286,16 @@ class BaseBot:
                 self.stop_symbol(symbol)
                 return False
 
+            # Chặn trước lệnh chắc chắn bị từ chối vì nhỏ hơn MIN_NOTIONAL
+            symbol_meta = get_symbol_info(symbol)
+            if symbol_meta and qty * current_price < symbol_meta["min_notional"]:
+                self.log(
+                    f"❌ {symbol} - Giá trị lệnh {qty * current_price:.2f} < "
+                    f"tối thiểu {symbol_meta['min_notional']:.2f} USDT"
+                )
+                self.stop_symbol(symbol)
+                return False
+
             cancel_all_orders(symbol, self.api_key, self.api_secret)
             time.sleep(1)
 
@@ -2500,7 +5305,10 @@ class BaseBot:
                 avg_price = float(result.get("avgPrice", current_price))
 
                 if executed_qty >= 0:
-                    time.sleep(1)
+                    fill = wait_for_order_update(self.api_key, result["orderId"], timeout=1)
+                    if fill and fill["avgPrice"] > 0:
+                        executed_qty = fill["executedQty"]
+                        avg_price = fill["avgPrice"]
                     self._check_symbol_position(symbol)
 
                     if not self.symbol_data[symbol]["position_open"]:
@@ -2600,6 +5408,7 @@ class BaseBot:
             self.stop_symbol(symbol)
             return False
 
+    @track_api_cost(CALL_SITE_ORDER)
     def _close_symbol_position(self, symbol, reason=""):
         try:
             self._check_symbol_position(symbol)
@@ -2629,7 +5438,7 @@ class BaseBot:
                 symbol, close_side, close_qty, self.api_key, self.api_secret
             )
             if result and "orderId" in result:
-                current_price = self.get_current_price(symbol)
+                current_price = self.get_current_price(symbol, PRIORITY_ORDER)
                 pnl = 0
                 if self.symbol_data[symbol]["entry"] > 0:
                     if self.symbol_data[symbol]["side"] == "BUY":
@@ -2687,6 +5496,7 @@ class BaseBot:
             self.symbol_data[symbol]["close_attempted"] = False
             return False
 
+    @track_api_cost(CALL_SITE_MARGIN)
     def _check_margin_safety(self):
         """
         Kiểm tra an toàn ký quỹ toàn tài khoản futures.
@@ -2735,7 +5545,8 @@ class BaseBot:
         ):
             return
 
-        current_price = self.get_current_price(symbol)
+        # ROI trên sàn tính theo mark price
+        current_price = self.get_mark_price(symbol)
         if current_price <= 0:
             return
 
@@ -2803,7 +5614,7 @@ class BaseBot:
         if self.symbol_data[symbol]["position_open"]:
             self._close_symbol_position(symbol, "Dừng coin theo lệnh")
 
-        self.ws_manager.remove_symbol(symbol)
+        self.ws_manager.remove_symbol(symbol, owner=self.bot_id)
         self.coin_manager.unregister_coin(symbol)
 
         if symbol in self.symbol_data:
@@ -2833,6 +5644,7 @@ class BaseBot:
         stopped_count = self.stop_all_symbols()
         self.log(f"🔴 Bot đã dừng - Đã dừng {stopped_count} coin")
 
+    @track_api_cost(CALL_SITE_POSITION)
     def check_global_positions(self):
         """
         Quyết định hướng vào lệnh tiếp theo dựa trên ROI TỔNG:
@@ -3136,7 +5948,11 @@ class BotManager:
         self.symbol_locks = defaultdict(threading.Lock)
 
         if api_key and api_secret:
-            self._verify_api_connection()
+            configure_leverage_brackets(api_key, api_secret)
+            start_market_data_refresher()
+            if self._verify_api_connection():
+                seed_applied_leverage(api_key, api_secret)
+                start_user_data_stream(api_key, api_secret)
             self.log("🟢 HỆ THỐNG BOT ĐA CHIẾN LƯỢC ĐÃ KHỞI ĐỘNG")
 
             self.telegram_thread = threading.Thread(
@@ -3319,6 +6135,67 @@ class BotManager:
         except Exception as e:
             return f"❌ Lỗi thống kê: {str(e)}"
 
+    def get_api_cost_summary(self):
+        """Chi phí API theo bot: số request, weight và thời gian chờ+mạng"""
+        try:
+            costs = get_api_costs()
+            if not costs:
+                return "📡 **CHI PHÍ API THEO BOT**: Chưa có dữ liệu\n"
+
+            elapsed_minutes = max((time.time() - _API_COSTS.start_time) / 60, 1)
+            total_weight = sum(c["weight"] for c in costs.values())
+            site_names = {
+                CALL_SITE_SCAN: "quét",
+                CALL_SITE_POSITION: "vị thế",
+                CALL_SITE_MARGIN: "ký quỹ",
+                CALL_SITE_ORDER: "lệnh",
+                CALL_SITE_OTHER: "khác",
+            }
+
+            summary = "📡 **CHI PHÍ API THEO BOT**\n"
+            summary += (
+                f"• Tổng weight: {total_weight} "
+                f"(~{total_weight / elapsed_minutes:.0f}/phút, giới hạn {_REQUEST_WEIGHT_LIMIT_1M}/phút)\n\n"
+            )
+
+            ranked = sorted(costs.items(), key=lambda item: item[1]["weight"], reverse=True)
+            ranked, rest = ranked[:_API_COST_SUMMARY_TOP_N], ranked[_API_COST_SUMMARY_TOP_N:]
+            for bot_id, cost in ranked:
+                bot = self.bots.get(bot_id)
+                strategy = getattr(bot, "dynamic_strategy", None) if bot else None
+                if bot is not None and bot.symbol:
+                    strategy = "tĩnh"
+                share = cost["weight"] / total_weight * 100 if total_weight else 0
+                summary += f"🔹 **{bot_id}**"
+                if strategy:
+                    summary += f" ({strategy})"
+                summary += (
+                    f"\n   {cost['requests']} req | weight {cost['weight']} ({share:.1f}%) | "
+                    f"{cost['wall_time']:.1f}s\n"
+                )
+                site_parts = [
+                    f"{site_names.get(site, site)}: {site_cost['weight']}"
+                    for site, site_cost in sorted(
+                        cost["sites"].items(), key=lambda item: item[1]["weight"], reverse=True
+                    )
+                ]
+                summary += f"   ⚖️ {' | '.join(site_parts)}\n"
+
+            if rest:
+                rest_weight = sum(cost["weight"] for _, cost in rest)
+                rest_share = rest_weight / total_weight * 100 if total_weight else 0
+                summary += (
+                    f"🔸 {len(rest)} bot khác: {sum(cost['requests'] for _, cost in rest)} req | "
+                    f"weight {rest_weight} ({rest_share:.1f}%)\n"
+                )
+
+            if len(summary) > _TELEGRAM_MAX_MESSAGE:
+                summary = summary[: _TELEGRAM_MAX_MESSAGE - 20] + "\n... (đã rút gọn)\n"
+            return summary
+
+        except Exception as e:
+            return f"❌ Lỗi thống kê chi phí API: {str(e)}"
+
     def log(self, message):
         important_keywords = [
             "❌",
@@ -4518,13 +7395,14 @@ class BotManager:
             return
 
         elif text == "📊 Thống kê":
-            summary = self.get_position_summary()
-            send_telegram(
-                summary,
-                chat_id=chat_id,
-                bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id,
-            )
+            # Gửi riêng chi phí API: ghép chung dễ vượt giới hạn 4096 ký tự của Telegram
+            for summary in (self.get_position_summary(), self.get_api_cost_summary()):
+                send_telegram(
+                    summary,
+                    chat_id=chat_id,
+                    bot_token=self.telegram_bot_token,
+                    default_chat_id=self.telegram_chat_id,
+                )
             return
 
         elif text == "💰 Số dư":